@@ -0,0 +1,5 @@
+python src/batch_generate.py \
+    --manifest=MANIFEST \
+    --model_idx=gpt-4 \
+    --concurrency=8 \
+    --output_dir=data
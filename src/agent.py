@@ -1,36 +1,122 @@
-from copy import deepcopy
-from typing import Annotated
+from copy import copy
+from typing import Annotated, AsyncIterable, Awaitable, Callable, Sequence
 from kani import Kani
-from kani.engines.httpclient import BaseClient
-from kani.models import ChatMessage
+from kani.engines.base import BaseCompletion, Completion
+from kani.models import ChatMessage, ChatRole
+from kani.streaming import StreamManager
+from cache import ResponseCache
+from context import ContextPolicy, build_summary_prompt
+from retrieval import WikiRetriever
+from prefilter import SupportPrefilter
+from metrics import MetricsRecorder, recorder, traced, current_method, get_role
+from scheduler import prompt_tokens_scope
+from prompts import SUPPORT_OPTIONS, CHECK_SUPPORT, GENERATE_SUPPORT, RATE_CLASS, GENERATE_POINTS, GENERATE_IMPROVEMENTS, GENERATE_SUMMARY, EXTRACT_TOPIC, EXPLAIN_ARTICLE, build_prompt, prefixes
 
 import re
-import random
+import math
 import json
+import asyncio
+import logging
+import time
 
+log = logging.getLogger(__name__)
 
-class WikiClient(BaseClient):
-    SERVICE_BASE = "https://en.wikipedia.org/w/api.php"
+SUMMARY_MODES = ['serial', 'concurrent', 'combined']  # The modes of Summarizer.summarize().
 
 
-# Extracting the class index in the output of a classification problem.
+# Extracting the class index in the output of a classification problem. Returns None if there is no valid index.
 def convert_into_class_idx(res: str, options: list):
     pattern = r'\d+'
-    matches = re.findall(pattern, res)
+    matches = re.findall(pattern, res if res is not None else '')
     if matches:
         index = int(matches[0])
-        if index >= len(options):
-            return random.choice(list(range(len(options))))
-        return index
-    else:
-        return random.choice(list(range(len(options))))
+        if index < len(options):
+            return index
+
+    log.warning(f"Could not parse the class index among {len(options)} options from the answer: {res!r}")
+    return None
+
+
+# The hyperparameters to constrain the answer into one option number, for the engines with a tiktoken tokenizer (e.g. OpenAI).
+def get_classification_hyperparams(engine, num_options: int):
+    tokenizer = getattr(engine, 'tokenizer', None)
+    if tokenizer is None or num_options > 10:
+        return {}
+
+    token_ids = [tokenizer.encode(str(o))[0] for o in range(num_options)]
+    return {
+        'max_tokens': 1,
+        'temperature': 0,
+        'logit_bias': {token_id: 100 for token_id in token_ids},
+        'logprobs': True,
+    }
+
+
+# The latest utterance of the teacher in the queries.
+def get_teacher_text(queries: Sequence[ChatMessage]):
+    teacher_msgs = [msg for msg in queries if msg.name == 'Teacher']
+    return teacher_msgs[-1].text if len(teacher_msgs) > 0 else ''
+
+
+# The probability of the generated answer, if the engine reports the log probabilities.
+def get_answer_probability(completion: BaseCompletion):
+    try:
+        return math.exp(completion.openai_completion.choices[0].logprobs.content[0].logprob)
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+# The prompt tokens served from the prompt cache of the provider, if reported.
+def get_cached_tokens(completion: BaseCompletion):
+    try:
+        return completion.openai_completion.usage.prompt_tokens_details.cached_tokens
+    except AttributeError:
+        return None
+
+
+# A part of the combined summary as text. A list, e.g. of the main points, is put one item per line.
+def format_summary_part(value):
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return '\n'.join(value)
+    if not isinstance(value, str):
+        raise TypeError(f"Not a text: {value!r}")
+    return value
 
 
 class Participant(Kani):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, name: str=None, cache: ResponseCache=None, cache_scope: str=None, context_policy: ContextPolicy=None, metrics: MetricsRecorder=None, **kwargs):
+        """
+        :param name: The name of the agent in the classroom (e.g. 'Teacher', 'Student-1').
+            Agents with different names never share the cached responses.
+        :param cache: The response cache to skip the completions already made with the same prompt.
+        :param cache_scope: Separating the cached responses of the agents in different scopes (e.g. the seeds of the lectures), even with the same name.
+        :param context_policy: The policy to bound the chat history in each prompt. The whole history is still kept.
+        :param metrics: The recorder of the spans of the model calls. By default, the process-wide recorder.
+        """
         super().__init__(*args, **kwargs)
+        self.name = name if name is not None else type(self).__name__
+        self.cache = cache
+        self.cache_scope = cache_scope
+        self.context_policy = context_policy
+        self.metrics = metrics if metrics is not None else recorder
+
+        # Measured for the span of the next model call.
+        self.lock_wait = 0.0
+        self.num_prompt_messages = 0
+        self.prefix_tokens = 0
+        self.num_prompt_tokens = 0
+        self.next_prompt = None  # The prompt built for the span, reused by the model call.
+
 
-    async def chat_round(self, queries: list[ChatMessage], **kwargs) -> ChatMessage:
+        # The rolling summary of the messages fallen out of the context window.
+        self.context_summary = None
+        self.summarized_upto = 0  # The index in the chat history up to which the summary covers.
+        self.summary_refreshed_at = 0  # The length of the chat history when the summary was refreshed.
+        self.round_start = 0  # The index of the first message added in the current round, always kept in the window.
+
+        self.num_parse_failures = 0  # The number of the classification answers which could not be parsed.
+
+    async def chat_round(self, queries: Sequence[ChatMessage], **kwargs) -> ChatMessage:
         """Perform a single chat round (user -> model -> user, no functions allowed).
 
         This is slightly faster when you are chatting with a kani with no AI functions defined.
@@ -39,118 +125,475 @@ class Participant(Kani):
         :param kwargs: Additional arguments to pass to the model engine (e.g. hyperparameters).
         :returns: The model's reply.
         """
+        completion = await self.chat_round_completion(queries, **kwargs)
+        return completion.message
+
+    async def chat_round_completion(self, queries: Sequence[ChatMessage], **kwargs) -> BaseCompletion:
+        """Like :meth:`chat_round`, but returns the whole completion (e.g. for the token counts or the log probabilities)."""
         kwargs = {**kwargs, "include_functions": False}
         # do the chat round
+        requested_at = time.perf_counter()
         async with self.lock:
+            self.lock_wait = time.perf_counter() - requested_at
+            self.round_start = len(self.chat_history)
             # add the user's chat input to the state
             for msg in queries:
                 await self.add_to_history(msg)
 
             # and get a completion
             completion = await self.get_model_completion(**kwargs)
-            message = completion.message
-            await self.add_to_history(message)
-            return message
+            await self.add_to_history(completion.message)
+            return completion
+
+    async def classify(self, queries: Sequence[ChatMessage], options: list[str], **kwargs):
+        """Performs a chat round whose answer is one option number, constrained to one token if the engine supports it.
+
+        :returns: The index of the chosen option and its probability (None if the engine does not report it).
+            The index is None if the answer could not be parsed, which is logged and counted in ``num_parse_failures``.
+        """
+        kwargs = {**get_classification_hyperparams(self.engine, len(options)), **kwargs}
+        completion = await self.chat_round_completion(queries, **kwargs)
+
+        index = convert_into_class_idx(completion.message.text, options)
+        if index is None:
+            self.num_parse_failures += 1
+            return None, None
+        return index, get_answer_probability(completion)
+
+    def chat_round_stream(self, queries: Sequence[ChatMessage], **kwargs) -> StreamManager:
+        """Like :meth:`chat_round`, but returns a stream of the tokens as they are generated.
 
-    async def chat_round_str(self, queries: list[ChatMessage], **kwargs) -> str:
-        """Like :meth:`chat_round`, but only returns the text content of the message."""
-        msg = await self.chat_round(queries, **kwargs)
+        The final message is added to the chat history once the stream is consumed.
+        """
+        kwargs = {**kwargs, "include_functions": False}
+        requested_at = time.perf_counter()
+
+        async def _impl():
+            # The stream starts once the lock is acquired.
+            self.lock_wait = time.perf_counter() - requested_at
+            self.round_start = len(self.chat_history)
+            # add the user's chat input to the state
+            for msg in queries:
+                await self.add_to_history(msg)
+
+            async for elem in self.get_model_stream(**kwargs):
+                yield elem
+
+        return StreamManager(_impl(), role=ChatRole.ASSISTANT, after=self.add_completion_to_history, lock=self.lock)
+
+    async def chat_round_str(self, queries: Sequence[ChatMessage], on_token: Callable[[str], Awaitable]=None, **kwargs) -> str:
+        """Like :meth:`chat_round`, but only returns the text content of the message.
+
+        :param on_token: If given, the completion is streamed and this coroutine function is called with each token.
+        """
+        if on_token is None:
+            msg = await self.chat_round(queries, **kwargs)
+            return msg.text
+
+        stream = self.chat_round_stream(queries, **kwargs)
+        async for token in stream:
+            await on_token(token)
+        msg = await stream.message()
         return msg.text
 
+    def get_window_start(self) -> int:
+        """Returns the index of the first message in the chat history within the token budget of the context policy.
+
+        The messages of the current round are always included, even if they alone exceed the budget.
+        """
+        remaining = self.context_policy.max_tokens
+        start = len(self.chat_history)
+        for message in reversed(self.chat_history):
+            remaining -= self.message_token_len(message)
+            if remaining < 0:
+                break
+            start -= 1
+
+        return min(start, self.round_start)
+
+    @traced
+    async def summarize_context(self, messages: list[ChatMessage]):
+        """Returns the rolling summary with the given messages folded into it, generated apart from the chat history."""
+        summarizer = self.fork([])
+        summarizer.context_policy = None
+        res = await summarizer.chat_round_str(build_summary_prompt(self.context_summary, messages))
+        return res
+
+    async def refresh_context_summary(self):
+        """Refreshes the rolling summary once every ``summary_every`` completions with only the messages fallen out of the window since the last refresh."""
+        if self.context_policy is None or self.context_policy.max_tokens is None or self.context_policy.summary_every is None:
+            return
+
+        start = self.get_window_start()
+        summarized_upto = min(self.summarized_upto, start)
+        if start > summarized_upto:
+            num_rounds = sum(1 for msg in self.chat_history[self.summary_refreshed_at:] if msg.role == ChatRole.ASSISTANT)
+            if num_rounds >= self.context_policy.summary_every:
+                self.context_summary = await self.summarize_context(self.chat_history[summarized_upto:start])
+                self.summarized_upto = start
+                self.summary_refreshed_at = len(self.chat_history)
+
+    async def get_context_messages(self) -> list[ChatMessage]:
+        """Returns the part of the chat history sent to the model, after the rolling summary of the earlier messages if any."""
+        if self.context_policy is None or self.context_policy.max_tokens is None:
+            return list(self.chat_history)
+
+        await self.refresh_context_summary()
+        start = self.get_window_start()
+        if self.context_summary is None:
+            return self.chat_history[start:]
+        return [self.get_summary_message()] + self.chat_history[start:]
+
+    def get_class_messages(self) -> list[ChatMessage]:
+        """Returns the whole class so far, e.g. for the summarizer: the rolling summary and all messages after it if there is one,
+        otherwise the whole chat history."""
+        if self.context_summary is None:
+            return list(self.chat_history)
+        return [self.get_summary_message()] + self.chat_history[self.summarized_upto:]
+
+    def get_summary_message(self):
+        return ChatMessage.system(name='Summary', content=f"Summary of the earlier class: {self.context_summary}")
+
+    async def get_prompt(self) -> list[ChatMessage]:
+        if self.next_prompt is not None:
+            prompt, self.next_prompt = self.next_prompt, None
+            return prompt
+
+        if self.context_policy is None or self.context_policy.max_tokens is None:
+            prompt = await super().get_prompt()
+        else:
+            prompt = self.always_included_messages + await self.get_context_messages()
+
+        self.num_prompt_messages = len(prompt)
+        return prompt
+
+    async def build_next_prompt(self) -> list[ChatMessage]:
+        """Returns the prompt of the next model call, kept to be reused by the call."""
+        self.next_prompt = None
+        prompt = await self.get_prompt()
+        self.next_prompt = prompt
+        return prompt
+
+    def observe_prompt(self, prompt: list[ChatMessage]):
+        # Measuring the prefix of the prompt already sent in an earlier call, only when it is actually sent to the model.
+        self.prefix_tokens, self.num_prompt_tokens = prefixes.observe(getattr(self.engine, 'model', None), prompt, self.message_token_len)
+
+    def get_cache_key(self, messages: list[ChatMessage], include_functions: bool, kwargs: dict) -> str:
+        model = getattr(self.engine, 'model', type(self.engine).__name__)
+        hyperparams = {**getattr(self.engine, 'hyperparams', {}), **kwargs, 'include_functions': include_functions}
+        scope = self.name if self.cache_scope is None else f"{self.cache_scope}/{self.name}"
+        return self.cache.make_key(model, scope, messages, hyperparams)
+
+    def record_span(self, start: float, completion: BaseCompletion, cached: bool=False, stream: bool=False):
+        self.metrics.record({
+            'agent': self.name,
+            'role': get_role(self.name),
+            'method': current_method.get() or 'chat_round',
+            'model': getattr(self.engine, 'model', None),
+            'stream': stream,
+            'cached': cached,
+            'latency': time.perf_counter() - start,
+            'lock_wait': self.lock_wait,
+            'num_messages': self.num_prompt_messages,
+            'prompt_tokens': completion.prompt_tokens,
+            'completion_tokens': completion.completion_tokens,
+            'prefix_tokens': self.prefix_tokens,
+            'cached_prompt_tokens': get_cached_tokens(completion),
+            'time': time.time(),
+        })
+        self.lock_wait = 0.0
+        self.prefix_tokens = 0
+        self.next_prompt = None  # The prompt built for the span, reused by the model call.
+
+    async def get_model_completion(self, include_functions: bool = True, **kwargs) -> BaseCompletion:
+        # The summary has its own span.
+        await self.refresh_context_summary()
+        start = time.perf_counter()
+        messages = await self.build_next_prompt()
+        key = self.get_cache_key(messages, include_functions, kwargs) if self.cache is not None else None
+        if key is not None and (message := await asyncio.to_thread(self.cache.get, key)) is not None:
+            self.next_prompt = None
+            completion = Completion(message)
+            self.record_span(start, completion, cached=True)
+            return completion
+
+        self.observe_prompt(messages)
+        with prompt_tokens_scope(self.num_prompt_tokens):
+            completion = await super().get_model_completion(include_functions=include_functions, **kwargs)
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, completion.message)
+        self.record_span(start, completion)
+        return completion
+
+    async def get_model_stream(self, include_functions: bool = True, **kwargs) -> AsyncIterable[str | BaseCompletion]:
+        # The summary has its own span.
+        await self.refresh_context_summary()
+        start = time.perf_counter()
+        messages = await self.build_next_prompt()
+        key = self.get_cache_key(messages, include_functions, kwargs) if self.cache is not None else None
+        if key is not None and (message := await asyncio.to_thread(self.cache.get, key)) is not None:
+            self.next_prompt = None
+            yield message.text
+            yield Completion(message)
+            self.record_span(start, Completion(message), cached=True, stream=True)
+            return
+
+        self.observe_prompt(messages)
+        tokens = []
+        completion = None
+        with prompt_tokens_scope(self.num_prompt_tokens):
+            async for elem in super().get_model_stream(include_functions=include_functions, **kwargs):
+                if isinstance(elem, BaseCompletion):
+                    completion = elem
+                else:
+                    tokens.append(elem)
+                yield elem
+
+        if completion is None:
+            completion = Completion(ChatMessage.assistant(''.join(tokens)))
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, completion.message)
+        self.record_span(start, completion, stream=True)
+
+    def get_state(self):
+        """Returns the chat history and the rolling summary, e.g. to save in a checkpoint."""
+        return {
+            'chat_history': list(self.chat_history),
+            'context_summary': self.context_summary,
+            'summarized_upto': self.summarized_upto,
+            'summary_refreshed_at': self.summary_refreshed_at,
+        }
+
+    def set_state(self, state: dict):
+        self.chat_history = list(state['chat_history'])
+        self.context_summary = state['context_summary']
+        self.summarized_upto = state['summarized_upto']
+        self.summary_refreshed_at = state['summary_refreshed_at']
+
+    def fork(self, chat_history: Sequence[ChatMessage]=None):
+        """Returns a copy of this agent sharing the same engine and the messages, with its own chat history and lock.
+
+        This is useful to run several completions of the same agent at once.
+
+        :param chat_history: The chat history to start with. By default, a copy of the current chat history.
+        """
+        agent = copy(self)
+        agent.chat_history = list(self.chat_history if chat_history is None else chat_history)
+        agent.lock = asyncio.Lock()
+        return agent
+
 
 class Supporter(Participant):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, prefilter: SupportPrefilter=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.prefilter = prefilter  # The local classifier deciding the clear cases before the model is asked.
 
-    async def check_support(self, queries: list[ChatMessage]):
-        options = ['Yes', 'No']
-        options_str = '\n'.join([f"{o}: {option}" for o, option in enumerate(options)])
-        queries.append(ChatMessage.system(content=f"Do you think the teacher's answer needs some support or not? You should answer only in number.\n\n{options_str}"))
-
-        res = await self.chat_round_str(queries)
-        res = convert_into_class_idx(res, options)
+        # The statistics of the speculative support.
+        self.num_speculations = 0
+        self.num_wasted = 0
 
-        return options[res]
+    @traced
+    async def check_support(self, queries: Sequence[ChatMessage]):
+        res, _ = await self.classify_support(queries)
+        return res
 
-    async def generate_support(self, queries: list[ChatMessage]):
-        query = "Suggest about 2-3 additional subtopics or extensions you think useful for the teacher to help the students understand better.\n\nYour answer should start with: 'It might be great to explain more about...' and then the list of suggestions."
-        queries.append(ChatMessage.system(content=query))
+    @traced
+    async def classify_support(self, queries: Sequence[ChatMessage]):
+        """Like :meth:`check_support`, but also returns the probability of the decision (None if unavailable).
 
-        res = await self.chat_round_str(queries)
+        If the answer cannot be parsed, the decision falls back to 'No'.
+        """
+        options = SUPPORT_OPTIONS
+        prompt = build_prompt(CHECK_SUPPORT, queries)
+
+        if self.prefilter is not None:
+            res, prob = self.prefilter.predict(get_teacher_text(queries))
+            if res is not None:
+                # Keeping the history the same as when the model answers, so that the extensions can follow.
+                async with self.lock:
+                    for msg in prompt:
+                        await self.add_to_history(msg)
+                    await self.add_to_history(ChatMessage.assistant(str(options.index(res))))
+                return res, prob
+
+        res, prob = await self.classify(prompt, options)
+        if res is None:
+            return 'No', None
+
+        return options[res], prob
+
+    @traced
+    async def generate_support(self, queries: Sequence[ChatMessage], on_token: Callable[[str], Awaitable]=None):
+        res = await self.chat_round_str(build_prompt(GENERATE_SUPPORT, queries), on_token=on_token)
         return res
 
+    async def speculate_support(self, queries: Sequence[ChatMessage]):
+        """Runs :meth:`check_support` and :meth:`generate_support` at once.
+
+        This saves one round-trip on each turn at the cost of the tokens for the extensions,
+        which are thrown away when the support is not needed.
+
+        :returns: The decision and the extensions (None if the decision is 'No').
+        """
+        if self.prefilter is not None and self.prefilter.decide(get_teacher_text(queries))[0] is not None:
+            # Nothing to speculate on if the decision is made locally.
+            res = await self.check_support(queries)
+            extensions = await self.generate_support(queries) if res == 'Yes' else None
+            return res, extensions
+
+        generator = self.fork()
+        num_forked = len(generator.chat_history)
+        res, extensions = await asyncio.gather(
+            self.check_support(queries),
+            generator.generate_support(queries)
+        )
+
+        self.num_speculations += 1
+        if res == 'Yes':
+            # Keeping the history the same as when the extensions are generated after the decision.
+            self.chat_history += generator.chat_history[num_forked:]
+            return res, extensions
+
+        self.num_wasted += 1
+        return res, None
+
+    @property
+    def waste_rate(self):
+        if self.num_speculations == 0:
+            return 0.0
+        return self.num_wasted / self.num_speculations
+
 
 class Summarizer(Participant):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    async def rate_class(self, queries: list[ChatMessage]):
-        query = "Rate the overall quality of the lecture in terms of the quality of the content and how detailed and understandable the teacher's explanation is. You should generate the score between 1 to 10 and a brief reason in one sentence."
-        queries.append(ChatMessage.system(content=query))
-
-        res = await self.chat_round_str(queries)
+    @traced
+    async def rate_class(self, queries: Sequence[ChatMessage], on_token: Callable[[str], Awaitable]=None):
+        res = await self.chat_round_str(build_prompt(RATE_CLASS, queries, shared_transcript=True), on_token=on_token)
         return res
 
-    async def generate_points(self, queries: list[ChatMessage]):
-        query = "Generate 2-3 essential subtopics or contents during the class. These could be the ones which most students were curious about or which you think as the important contents to refer to for improving the course quality in the future. Your answer should start with: 'The main points of today's class: ' and then the list of contents. Each item should be as simple as possible."
-        queries.append(ChatMessage.system(content=query))
+    @traced
+    async def generate_points(self, queries: Sequence[ChatMessage], on_token: Callable[[str], Awaitable]=None):
+        res = await self.chat_round_str(build_prompt(GENERATE_POINTS, queries, shared_transcript=True), on_token=on_token)
+        return res
 
-        res = await self.chat_round_str(queries)
+    @traced
+    async def generate_improvements(self, queries: Sequence[ChatMessage], main_points: str, on_token: Callable[[str], Awaitable]=None):
+        res = await self.chat_round_str(build_prompt(GENERATE_IMPROVEMENTS, queries, tail=main_points, shared_transcript=True), on_token=on_token)
         return res
 
-    async def generate_improvements(self, queries: list[ChatMessage], main_points: str):
-        query = f"Generate your recommendation to the teacher so that the course quality can be improve next time based on the suggested main points of the class. You should only give recommendations without any additional ratings or repetition of main points.\n\n{main_points}"
-        queries.append(ChatMessage.system(content=query))
+    @traced
+    async def generate_summary(self, queries: Sequence[ChatMessage]):
+        """Generates the rating, the main points and the improvements in one completion.
 
-        res = await self.chat_round_str(queries)
-        return res
+        :returns: The dict of 'rate', 'main_points' and 'improvements', or None if the answer could not be parsed or any of them is not a text.
+        """
+        res = await self.chat_round_str(build_prompt(GENERATE_SUMMARY, queries, shared_transcript=True))
+        matches = re.findall(r'\{.*\}', res, flags=re.DOTALL)
+        try:
+            summary = json.loads(matches[0])
+            return {key: format_summary_part(summary[key]) for key in ['rate', 'main_points', 'improvements']}
+        except (IndexError, json.JSONDecodeError, KeyError, TypeError):
+            log.warning(f"Could not parse the summary: {res}")
+            return None
+
+    async def summarize(self, queries: Sequence[ChatMessage], mode: str='serial', on_token: dict[str, Callable[[str], Awaitable]]=None):
+        """Wraps up the lecture with the rating, the main points and the improvements.
+
+        Each completion runs on a fork of the summarizer starting from an empty history.
+
+        :param mode: 'serial' runs the three completions one by one, 'concurrent' runs the rating and the main points at once,
+            and 'combined' generates all of them in one completion, falling back to 'serial' if the answer is broken.
+        :param on_token: The token callbacks for 'rate', 'main_points' and 'improvements' to stream each part.
+            The 'combined' mode cannot be streamed, so the callbacks are not called.
+        :returns: The dict of 'rate', 'main_points' and 'improvements'.
+        """
+        on_token = on_token if on_token is not None else {}
+        if mode == 'combined':
+            summary = await self.fork([]).generate_summary(queries)
+            if summary is not None:
+                return summary
+            mode = 'serial'
+
+        if mode == 'concurrent':
+            score, main_points = await asyncio.gather(
+                self.fork([]).rate_class(queries, on_token=on_token.get('rate')),
+                self.fork([]).generate_points(queries, on_token=on_token.get('main_points'))
+            )
+        else:
+            score = await self.fork([]).rate_class(queries, on_token=on_token.get('rate'))
+            main_points = await self.fork([]).generate_points(queries, on_token=on_token.get('main_points'))
+        improvements = await self.fork([]).generate_improvements(queries, main_points, on_token=on_token.get('improvements'))
+
+        return {'rate': score, 'main_points': main_points, 'improvements': improvements}
 
 
 class PersonalizedTutor(Participant):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, retriever: WikiRetriever=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.wiki_client = WikiClient()
+        self.retriever = retriever if retriever is not None else WikiRetriever()
 
     async def search_articles(self, query: str):
         """
         If there is a specific topic to search in Wiki,
         call this function with the query string.
         """
+        return await self.retriever.search_articles(query)
 
-        resp = await self.wiki_client.get(
-            "/",
-            params={"action": "opensearch", "format": "json", "search": query}
-        )
+    async def search_content(self, title: str):
+        return await self.retriever.search_content(title)
 
-        if resp[1] is not None:
-            return resp[1]
-        return None
+    @traced
+    async def extract_topic(self, name: str, background: str, queries: Sequence[ChatMessage]):
+        """Returns the topic word most helpful to the student, or None if there is none."""
+        # The instruction and the transcript come first, so that they are the same for all students of the class.
+        topic = await self.chat_round_str(build_prompt(EXTRACT_TOPIC, queries, tail=f"Student: {name}\n\nStudent background: {background}."))
 
-    async def search_content(self, title: str):
-        resp = await self.wiki_client.get(
-            "/",
-            params={
-                "action": "query",
-                "format": "json",
-                "prop": "extracts",
-                "titles": title,
-                "explaintext": 1,
-                "formatversion": 2,
-            },
-        )
-        page = resp["query"]["pages"][0]
-        if extract := page.get("extract"):
-            return extract
-
-    async def generate_help(self, name: str, background: str, queries: list[ChatMessage]):
-        query = f"Generate one topic word which would be most helpful to the student {name}. If there is none, just generate 'None'.\n\nStudent background: {background}."
-        topic = await self.chat_round_str(queries + [ChatMessage.system(content=query)])
-
-        if 'None' not in topic:
-            titles = await self.search_articles(topic)
-
-            if titles is not None and len(titles) > 0:
-                content = await self.search_content(titles[0])
-                query = f"Generate the summarization of given article in 2-3 sentences to help the student.\n\n{content[:1000]}"
-                res = await self.chat_round_str([ChatMessage.system(content=query)])
-                return res
+        if 'None' in topic:
+            return None
+        return topic
+
+    @traced
+    async def explain_article(self, content: str):
+        res = await self.chat_round_str(build_prompt(EXPLAIN_ARTICLE, tail=content[:1000]))
+        return res
+
+    @traced
+    async def generate_help(self, name: str, background: str, queries: Sequence[ChatMessage]):
+        topic = await self.extract_topic(name, background, queries)
+
+        if topic is not None:
+            article = await self.retriever.find_article(topic)
+
+            if article is not None:
+                _, content = article
+                return await self.explain_article(content)
+
+    async def generate_help_batch(self, roster: list[tuple[str, str]], queries: Sequence[ChatMessage]):
+        """Generates the help for a whole class at once.
+
+        The topics of all students are extracted concurrently, and each distinct topic is searched and explained only once.
+
+        :param roster: The list of (name, background) of the students.
+        :returns: The list of dicts with 'name', 'topic' and 'help' in the order of the roster.
+        """
+        topics = await asyncio.gather(*[self.fork([]).extract_topic(name, background, queries) for name, background in roster])
+        keys = [topic.strip().strip('.').lower() if topic is not None else None for topic in topics]
+
+        async def _explain(topic: str):
+            article = await self.retriever.find_article(topic)
+            if article is None:
+                return None
+            _, content = article
+            return await self.fork([]).explain_article(content)
+
+        unique_topics = {key: topic for key, topic in zip(keys, topics) if key is not None}
+        helps = await asyncio.gather(*[_explain(topic) for topic in unique_topics.values()])
+        helps = dict(zip(unique_topics.keys(), helps))
+
+        return [{
+            'name': name,
+            'topic': topic,
+            'help': helps[key] if key is not None else None
+        } for (name, _), topic, key in zip(roster, topics, keys)]
@@ -0,0 +1,134 @@
+from generate_data import run_lecture, build_classroom, get_output_path, export_logs
+from cache import ResponseCache
+from prefilter import SupportPrefilter
+from engines import EngineRouter, load_engine_router
+from scheduler import priority_scope, BATCH
+from dataset_writer import DatasetWriter, make_run_id
+from metrics import MetricsRecorder, JSONLExporter, recorder
+
+import argparse
+import random
+import asyncio
+import os
+import json
+
+
+# Loading the jobs in the manifest. Each line is a JSON object with (topic, seed, num_students, max_turns).
+def load_manifest(path: str, defaults: dict):
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            # The engine is shared by all jobs, so the model cannot be overridden per job.
+            job = {**defaults, **json.loads(line), 'model_idx': defaults['model_idx']}
+            jobs.append(argparse.Namespace(**job))
+
+    return jobs
+
+
+async def run_job(job, engines: EngineRouter, semaphore: asyncio.Semaphore, output_dir: str, cache: ResponseCache=None, prefilter: SupportPrefilter=None, writer: DatasetWriter=None):
+    if writer is None:
+        path = get_output_path(job, output_dir=output_dir)
+        finished = os.path.isfile(path)
+    else:
+        path = f"{writer.output_dir} (run {make_run_id(job)})"
+        finished = writer.is_finished(make_run_id(job))
+    if finished:
+        # Already finished in the previous run.
+        return 'skipped'
+
+    async with semaphore:
+        # Each lecture has its own random state so that concurrent jobs do not affect each other's sampling.
+        rng = random.Random(job.seed)
+        metrics = MetricsRecorder(parent=recorder)
+        teacher, students, supporter, summarizer = build_classroom(job, engines, cache=cache, prefilter=prefilter, metrics=metrics)
+        run = writer.start_run(job) if writer is not None else None
+        # The interactive requests sharing the engines go first.
+        with priority_scope(BATCH):
+            await run_lecture(job, teacher, students, supporter, summarizer, rng=rng, verbose=False, run=run)
+        if writer is None:
+            export_logs(teacher.chat_history, path)
+
+    calls = metrics.summary()
+    usage = f"{sum(c['calls'] for c in calls)} calls, {sum(c['prompt_tokens'] + c['completion_tokens'] for c in calls)} tokens, ${sum(c['cost'] for c in calls):.4f}"
+    if job.speculative_support:
+        print(f"Finished: {path} ({usage}, speculative support wasted: {supporter.num_wasted} / {supporter.num_speculations})")
+    else:
+        print(f"Finished: {path} ({usage})")
+    return 'finished'
+
+
+async def run_batch(jobs: list, engines: EngineRouter, concurrency: int, output_dir: str, cache: ResponseCache=None, prefilter: SupportPrefilter=None, writer: DatasetWriter=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        results = await asyncio.gather(*[run_job(job, engines, semaphore, output_dir, cache=cache, prefilter=prefilter, writer=writer) for job in jobs], return_exceptions=True)
+    finally:
+        await engines.close()
+        if writer is not None:
+            writer.close()
+
+    num_failed = 0
+    for job, res in zip(jobs, results):
+        if isinstance(res, Exception):
+            num_failed += 1
+            print(f"Failed: topic={job.topic}, seed={job.seed} ({type(res).__name__}: {res})")
+
+    print(f"Finished: {results.count('finished')} / Skipped: {results.count('skipped')} / Failed: {num_failed}")
+    print(recorder.report())
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+    if prefilter is not None:
+        print(f"Support pre-filter: {prefilter.stats()}")
+    for engine in engines.all():
+        if hasattr(engine, 'scheduler'):
+            print(f"Scheduler of {engine.model}: {engine.scheduler.stats()}")
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manifest', type=str, required=True, help="The JSONL file of jobs (topic, seed, num_students, max_turns).")
+    parser.add_argument('--model_idx', type=str, default='gpt-4', help="The model index to use. 'mock' runs the offline engine.")
+    parser.add_argument('--concurrency', type=int, default=8, help="The maximum number of lectures running at once.")
+    parser.add_argument('--output_dir', type=str, default='data', help="The directory to export the data.")
+    parser.add_argument('--seed', type=int, default=555, help="The default random seed.")
+    parser.add_argument('--num_students', type=int, default=4, help="The default number of students in the class.")
+    parser.add_argument('--max_turns', type=int, default=20, help="The default maximum number of tuns in a chat.")
+    parser.add_argument('--simultaneous', action='store_true', help="Letting the chosen students answer the same teacher turn concurrently by default.")
+    parser.add_argument('--speculative_support', action='store_true', help="Generating the extensions while checking the support by default.")
+    parser.add_argument('--summary_mode', type=str, default='serial', choices=['serial', 'concurrent', 'combined'], help="How to generate the rating, the main points and the improvements by default.")
+    parser.add_argument('--context_tokens', type=int, default=None, help="The default token budget of the chat history sent by the teacher and the students.")
+    parser.add_argument('--summary_every', type=int, default=None, help="The default number of turns between the refreshes of the rolling summary.")
+    parser.add_argument('--engine_config', type=str, default=None, help="The JSON file assigning an engine to each role. If not set, all agents use the model of --model_idx.")
+    parser.add_argument('--cache_path', type=str, default=None, help="The SQLite file to cache the responses. If not set, the responses are not cached.")
+    parser.add_argument('--prefilter', type=str, default=None, help="The pre-filter trained by prefilter.py, shared by all lectures.")
+    parser.add_argument('--prefilter_threshold', type=float, default=0.9, help="The minimum confidence of the pre-filter to skip the model.")
+    parser.add_argument('--metrics_path', type=str, default=None, help="The JSONL file to append the span of each model call to.")
+    parser.add_argument('--dataset_dir', type=str, default=None, help="The directory of the sharded JSONL dataset shared by all lectures. The unfinished lectures resume from their checkpoints.")
+    parser.add_argument('--shard_size', type=int, default=256 * 1024 * 1024, help="The number of bytes in each shard of the dataset.")
+    parser.add_argument('--compress', action='store_true', help="Compressing the shards of the dataset with gzip.")
+
+    args = parser.parse_args()
+
+    defaults = {
+        'seed': args.seed,
+        'model_idx': args.model_idx,
+        'num_students': args.num_students,
+        'max_turns': args.max_turns,
+        'simultaneous': args.simultaneous,
+        'speculative_support': args.speculative_support,
+        'summary_mode': args.summary_mode,
+        'context_tokens': args.context_tokens,
+        'summary_every': args.summary_every,
+    }
+    jobs = load_manifest(args.manifest, defaults)
+
+    engines = load_engine_router(args.model_idx, args.engine_config)
+
+    cache = ResponseCache(args.cache_path) if args.cache_path is not None else None
+    prefilter = SupportPrefilter.load(args.prefilter, threshold=args.prefilter_threshold) if args.prefilter is not None else None
+    if args.metrics_path is not None:
+        recorder.add_hook(JSONLExporter(args.metrics_path))
+    writer = DatasetWriter(args.dataset_dir, shard_size=args.shard_size, compress=args.compress) if args.dataset_dir is not None else None
+    asyncio.run(run_batch(jobs, engines, args.concurrency, args.output_dir, cache=cache, prefilter=prefilter, writer=writer))
@@ -0,0 +1,291 @@
+from mock_engine import MockEngine
+from engines import EngineRouter
+from generate_data import run_lecture, build_classroom
+from prefilter import SupportPrefilter
+
+from contextlib import asynccontextmanager
+
+import argparse
+import asyncio
+import importlib
+import statistics
+import random
+import tracemalloc
+import time
+import os
+import json
+
+import httpx
+
+# Keeping the personalized tutor away from Wikipedia so that the benchmark runs offline.
+MOCK_RESPONSES = {"Generate one topic word": "None"}
+
+SAMPLE_QUERIES = [
+    "Teacher||Today we are going to learn how plants make their own food using sunlight.",
+    "Student-1||Why do plants need sunlight to make food?",
+    "Student-2||Do plants eat at night too?",
+    "Teacher||Plants use the energy of sunlight to turn water and air into sugar, which is their food.",
+]
+
+
+def summarize_latencies(latencies: list[float]):
+    if len(latencies) < 2:
+        latencies = latencies * 2
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'count': len(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': percentiles[49],
+        'p99': percentiles[98],
+    }
+
+
+def configure_engine(engine: MockEngine, args):
+    while hasattr(engine, 'engine'):
+        engine = engine.engine  # Unwrapping the scheduled engines.
+    engine.latency = args.latency
+    engine.latency_std = args.latency_std
+    engine.token_latency = args.token_latency
+    engine.prompt_latency = args.prompt_latency
+    engine.responses = MOCK_RESPONSES
+
+
+# Starting an app of a server module with the offline engine and without the response cache.
+# It yields the app with the seconds taken to import the module and start up the worker.
+@asynccontextmanager
+async def load_app(module_name: str, args):
+    os.environ['MODEL_IDX'] = 'mock'
+    os.environ['CACHE_PATH'] = ''
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    app = module.create_app()
+    async with app.router.lifespan_context(app):
+        startup = time.perf_counter() - start
+        for engine in app.state.server.engines.all():
+            configure_engine(engine, args)
+
+        yield app, startup
+
+
+# Lectures/minute of the data generation pipeline.
+async def bench_lecture(args):
+    engine = MockEngine()
+    configure_engine(engine, args)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    prefilter = SupportPrefilter.load(args.prefilter, threshold=args.prefilter_threshold) if args.prefilter is not None else None
+
+    async def run_one(l: int):
+        job = argparse.Namespace(
+            topic=f"Topic {l}",
+            seed=l,
+            model_idx='mock',
+            num_students=args.num_students,
+            max_turns=args.max_turns,
+            simultaneous=args.simultaneous,
+            speculative_support=args.speculative_support,
+            summary_mode=args.summary_mode,
+            context_tokens=args.context_tokens,
+            summary_every=args.summary_every
+        )
+        async with semaphore:
+            start = time.perf_counter()
+            teacher, students, supporter, summarizer = build_classroom(job, EngineRouter(engine), prefilter=prefilter)
+            await run_lecture(job, teacher, students, supporter, summarizer, rng=random.Random(l), verbose=False)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[run_one(l) for l in range(args.num_lectures)])
+    total = time.perf_counter() - start
+
+    results = {
+        'lectures_per_minute': len(latencies) / total * 60,
+        'lecture_latency': summarize_latencies(latencies),
+    }
+    if prefilter is not None:
+        results['prefilter'] = prefilter.stats()
+    return results
+
+
+# Peak memory and CPU time of one long lecture, which should grow with the new messages only.
+async def bench_memory(args):
+    engine = MockEngine()
+    configure_engine(engine, args)
+    job = argparse.Namespace(
+        topic="Topic",
+        seed=0,
+        model_idx='mock',
+        num_students=args.num_students,
+        max_turns=args.max_turns,
+        simultaneous=args.simultaneous,
+        speculative_support=args.speculative_support,
+        summary_mode=args.summary_mode,
+        context_tokens=args.context_tokens,
+        summary_every=args.summary_every
+    )
+    teacher, students, supporter, summarizer = build_classroom(job, EngineRouter(engine))
+
+    tracemalloc.start()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    await run_lecture(job, teacher, students, supporter, summarizer, rng=random.Random(0), verbose=False)
+    latency, cpu_time = time.perf_counter() - start, time.process_time() - cpu_start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'num_students': args.num_students,
+        'max_turns': args.max_turns,
+        'latency': latency,
+        'cpu_time': cpu_time,
+        'cpu_time_per_turn': cpu_time / args.max_turns,
+        'peak_memory_mb': peak / 1024 / 1024,
+        'retained_memory_mb': current / 1024 / 1024,
+        'history_messages': len(teacher.chat_history) + sum(len(student.chat_history) for student in students),
+    }
+
+
+# Requests/sec and latency of each route of server_kani.py.
+async def bench_server(args):
+    # The routes run in this order, so that each request continues the session started by the same index.
+    routes = {
+        '/checksupport/': ('GET', {'queries': SAMPLE_QUERIES}),
+        '/extensions/': ('GET', {}),
+        '/rate/': ('GET', {'queries': SAMPLE_QUERIES}),
+        '/mainpoints/': ('GET', {}),
+        '/improvements/': ('GET', {'mainpoints': "The main points of today's class: sunlight, water, sugar."}),
+        '/summarize/': ('GET', {'queries': SAMPLE_QUERIES, 'mode': args.summary_mode}),
+        '/privatetutor/': ('GET', {'queries': SAMPLE_QUERIES, 'name': 'Alice', 'background': 'Alice likes drawing flowers.'}),
+        '/privatetutor/batch/': ('POST', {
+            'queries': SAMPLE_QUERIES,
+            'roster': [{'name': f"Student-{s+1}", 'background': f"Student-{s+1} likes drawing flowers."} for s in range(args.roster_size)]
+        }),
+    }
+    session_routes = ['/checksupport/', '/extensions/', '/rate/', '/mainpoints/', '/improvements/']
+    sessions = [None] * args.num_requests
+
+    async with load_app('server_kani', args) as (app, startup):
+        results = {'startup': startup}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            for route, (method, params) in routes.items():
+                semaphore = asyncio.Semaphore(args.concurrency)
+
+                async def request(r: int):
+                    async with semaphore:
+                        start = time.perf_counter()
+                        if method == 'POST':
+                            resp = await client.post(route, json=params)
+                        elif route in session_routes and sessions[r] is not None:
+                            resp = await client.get(route, params={**params, 'session': sessions[r]})
+                        else:
+                            resp = await client.get(route, params=params)
+                        resp.raise_for_status()
+                        latency = time.perf_counter() - start
+                    if route in session_routes:
+                        sessions[r] = resp.json()['session']
+                    return latency
+
+                start = time.perf_counter()
+                latencies = await asyncio.gather(*[request(r) for r in range(args.num_requests)])
+                total = time.perf_counter() - start
+
+                results[route] = {'requests_per_sec': len(latencies) / total, **summarize_latencies(latencies)}
+
+    return results
+
+
+# Driving one websocket session directly through ASGI. The client answers as soon as the server waits for the students.
+async def run_socket_session(app, topic: str, stream: bool=False):
+    connected = False
+    num_messages = 0
+    first_frame = None
+    start = time.perf_counter()
+
+    async def receive():
+        nonlocal connected, num_messages
+        if not connected:
+            connected = True
+            return {'type': 'websocket.connect'}
+        num_messages += 1
+        return {'type': 'websocket.receive', 'text': f"Could you explain more about {topic}? (question {num_messages})"}
+
+    async def send(message):
+        nonlocal first_frame
+        if message['type'] == 'websocket.send' and first_frame is None:
+            first_frame = time.perf_counter() - start
+
+    scope = {
+        'type': 'websocket',
+        'asgi': {'version': '3.0'},
+        'scheme': 'ws',
+        'server': ('benchmark', 80),
+        'client': ('benchmark', 50000),
+        'root_path': '',
+        'path': f"/simulate/{topic}",
+        'raw_path': f"/simulate/{topic}".encode('utf-8'),
+        'query_string': b'stream=true' if stream else b'',
+        'headers': [],
+        'subprotocols': [],
+    }
+    await app(scope, receive, send)
+
+    return time.perf_counter() - start, first_frame
+
+
+# Per-session latency of /simulate/{topic} under N concurrent clients.
+async def bench_socket(args):
+    async with load_app('socket_kani', args) as (app, startup):
+        start = time.perf_counter()
+        sessions = await asyncio.gather(*[run_socket_session(app, f"Topic{c}", stream=args.stream) for c in range(args.num_clients)])
+        total = time.perf_counter() - start
+
+    return {
+        'startup': startup,
+        'num_clients': args.num_clients,
+        'stream': args.stream,
+        'sessions_per_minute': len(sessions) / total * 60,
+        'session_latency': summarize_latencies([s[0] for s in sessions]),
+        'first_frame_latency': summarize_latencies([s[1] for s in sessions]),
+    }
+
+
+BENCHMARKS = {
+    'lecture': bench_lecture,
+    'server': bench_server,
+    'socket': bench_socket,
+    'memory': bench_memory,
+}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', type=str, default='all', choices=['all'] + list(BENCHMARKS.keys()), help="The benchmark to run.")
+    parser.add_argument('--latency', type=float, default=0.05, help="The mean latency of a mock completion in seconds.")
+    parser.add_argument('--latency_std', type=float, default=0.01, help="The standard deviation of the mock latency.")
+    parser.add_argument('--token_latency', type=float, default=0.0, help="The additional mock latency for each token.")
+    parser.add_argument('--prompt_latency', type=float, default=0.0, help="The additional mock latency for each prompt token.")
+    parser.add_argument('--concurrency', type=int, default=10, help="The number of lectures or requests running at once.")
+    parser.add_argument('--num_lectures', type=int, default=20, help="The number of lectures to simulate.")
+    parser.add_argument('--num_students', type=int, default=4, help="The number of students in the class.")
+    parser.add_argument('--max_turns', type=int, default=10, help="The maximum number of tuns in a chat.")
+    parser.add_argument('--simultaneous', action='store_true', help="Letting the chosen students answer the same teacher turn concurrently.")
+    parser.add_argument('--speculative_support', action='store_true', help="Generating the extensions while checking the support.")
+    parser.add_argument('--summary_mode', type=str, default='serial', choices=['serial', 'concurrent', 'combined'], help="How to wrap up the lectures.")
+    parser.add_argument('--context_tokens', type=int, default=None, help="The token budget of the chat history sent by the teacher and the students.")
+    parser.add_argument('--summary_every', type=int, default=None, help="The number of turns between the refreshes of the rolling summary.")
+    parser.add_argument('--prefilter', type=str, default=None, help="The pre-filter trained by prefilter.py for the lectures.")
+    parser.add_argument('--prefilter_threshold', type=float, default=0.9, help="The minimum confidence of the pre-filter to skip the model.")
+    parser.add_argument('--num_requests', type=int, default=50, help="The number of requests for each route.")
+    parser.add_argument('--roster_size', type=int, default=30, help="The number of students in each batch tutoring request.")
+    parser.add_argument('--num_clients', type=int, default=10, help="The number of concurrent websocket clients.")
+    parser.add_argument('--stream', action='store_true', help="Streaming the tokens over the websocket.")
+    parser.add_argument('--output', type=str, default=None, help="The JSON file to save the results.")
+
+    args = parser.parse_args()
+
+    targets = list(BENCHMARKS.keys()) if args.target == 'all' else [args.target]
+    results = {target: asyncio.run(BENCHMARKS[target](args)) for target in targets}
+    print(json.dumps(results, indent=4))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
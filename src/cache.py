@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from kani.models import ChatMessage
+
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import os
+
+
+# Disk-backed cache of the model completions, keyed by the hash of the whole request.
+class ResponseCache:
+    def __init__(self, path: str='cache/responses.db', max_entries: int=100000, ttl: float=None, evict_batch: int=None):
+        """
+        :param path: The SQLite file to store the responses.
+        :param max_entries: The maximum number of responses to keep. The least recently used ones are evicted first.
+        :param ttl: The number of seconds a response stays valid. If None, the responses never expire.
+        :param evict_batch: The number of responses evicted below ``max_entries`` at once, and of the hits written at once.
+            If None, 1% of ``max_entries``.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_batch = evict_batch if evict_batch is not None else max(1, max_entries // 100)
+
+        # The connection is shared by the threads the agents look up the cache in, one call at a time.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, message TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.conn.commit()
+
+        # The number of responses, counted again before evicting as the other workers add to the same file.
+        # A replaced response is counted twice until then.
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.accessed = {}  # key -> access time of the hits not written yet
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, scope: str, messages: list[ChatMessage], hyperparams: dict) -> str:
+        payload = json.dumps({
+            'model': model,
+            'scope': scope,
+            'messages': [msg.model_dump(mode='json') for msg in messages],
+            'hyperparams': hyperparams
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.conn.execute("SELECT message, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+
+            # The access times only order the eviction, so they are written with the next response or in a batch.
+            self.accessed[key] = now
+            if len(self.accessed) >= self.evict_batch:
+                self.flush()
+                self.conn.commit()
+            self.hits += 1
+        return ChatMessage.model_validate_json(row[0])
+
+    def put(self, key: str, message: ChatMessage):
+        data = message.model_dump_json()
+        with self.lock:
+            now = time.time()
+            self.accessed.pop(key, None)
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, data, now, now))
+            self.flush()
+            self.size += 1
+            if self.size > self.max_entries:
+                self.evict(now)
+            self.conn.commit()
+
+    def flush(self):
+        # Writing the access times of the hits, without committing. Called with the lock held.
+        if len(self.accessed) > 0:
+            self.conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?", [(t, key) for key, t in self.accessed.items()])
+            self.accessed.clear()
+
+    def evict(self, now: float):
+        # Evicting the expired responses, and then the least recently used ones down to a batch below the limit. Called with the lock held.
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if self.size > self.max_entries:
+            num_evicted = self.size - self.max_entries + self.evict_batch
+            self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)", (num_evicted,))
+            self.size -= num_evicted
+
+    def stats(self):
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.commit()
+            self.conn.close()
+
+
+# In-memory LRU cache whose entries expire after the TTL.
+class TTLCache:
+    def __init__(self, max_entries: int=1024, ttl: float=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (created time, value)
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        if key not in self.entries:
+            return False
+        created_at, _ = self.entries[key]
+        return self.ttl is None or time.time() - created_at <= self.ttl
+
+    def get(self, key, default=None):
+        if key not in self:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
@@ -0,0 +1,26 @@
+from kani.models import ChatMessage
+
+
+# How much of the chat history of an agent is sent to the model in each prompt.
+class ContextPolicy:
+    def __init__(self, max_tokens: int=None, summary_every: int=None):
+        """
+        :param max_tokens: The token budget of the chat history in each prompt. Only the latest messages within the budget are sent.
+            If None, the whole history is sent as long as it fits into the context size of the model.
+        :param summary_every: The number of completions after which the messages fallen out of the window are folded into
+            the rolling summary of the earlier class. If None, those messages are just dropped.
+        """
+        self.max_tokens = max_tokens
+        self.summary_every = summary_every
+
+
+def format_transcript(messages: list[ChatMessage]):
+    return '\n'.join(f"{msg.name if msg.name is not None else msg.role.value}: {msg.text}" for msg in messages)
+
+
+# Folding the new messages into the previous summary, so that each refresh only costs the new messages.
+def build_summary_prompt(summary: str, messages: list[ChatMessage]):
+    query = "Summarize the class so far in 3-5 sentences, keeping the contents taught by the teacher and the questions of the students. Merge the new messages into the previous summary if there is one."
+    content = f"Previous summary: {summary}\n\nNew messages:\n{format_transcript(messages)}" if summary else f"New messages:\n{format_transcript(messages)}"
+
+    return [ChatMessage.system(content=query), ChatMessage.user(content=content)]
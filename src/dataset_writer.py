@@ -0,0 +1,210 @@
+from kani.models import ChatMessage
+from session_store import encode_state, decode_state
+
+import argparse
+import hashlib
+import glob
+import gzip
+import json
+import zlib
+import time
+import os
+
+# The parameters of a lecture which decide its contents.
+RUN_PARAMS = ['topic', 'seed', 'model_idx', 'num_students', 'max_turns', 'simultaneous', 'speculative_support', 'summary_mode', 'context_tokens', 'summary_every']
+
+
+def get_run_params(args):
+    return {param: getattr(args, param, None) for param in RUN_PARAMS}
+
+
+def make_run_id(args):
+    payload = json.dumps(get_run_params(args), sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_messages(messages: list[ChatMessage]):
+    # The same format as the JSON files exported by generate_data.py.
+    return [{'role': msg.role.value, 'name': msg.name, 'content': msg.content} for msg in messages]
+
+
+# Appending the lectures turn by turn into sharded JSONL files, with an index of the runs and the checkpoints to resume them.
+#
+# output_dir/
+#     runs.jsonl                      The events of the runs: {"run_id", "status": "started" | "finished", "params", "time"}
+#     shards/shard-00000.jsonl(.gz)   The turns of the runs: {"run_id", "turn", "messages", "final"}, each shard written by one writer
+#     checkpoints/{run_id}.json       The state of the unfinished runs after their last turn.
+class DatasetWriter:
+    def __init__(self, output_dir: str, shard_size: int=256 * 1024 * 1024, compress: bool=False):
+        """
+        :param output_dir: The directory of the dataset.
+        :param shard_size: The number of bytes in a shard before a new shard is started.
+        :param compress: Compressing the shards with gzip.
+        """
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.compress = compress
+        os.makedirs(os.path.join(output_dir, 'shards'), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, 'checkpoints'), exist_ok=True)
+
+        # A new writer never appends to the existing shards, whose ends might be broken by a crash,
+        # nor to the ones of the other writers on the same directory.
+        self.shard_idx = len(glob.glob(os.path.join(output_dir, 'shards', 'shard-*')))
+        self.shard = None
+        self.shard_bytes = 0
+
+        self.runs = load_runs(output_dir)
+
+    def _open_shard(self):
+        ext = '.jsonl.gz' if self.compress else '.jsonl'
+        while self.shard is None:
+            path = os.path.join(self.output_dir, 'shards', f"shard-{self.shard_idx:05d}{ext}")
+            try:
+                # Taken by another writer in the meantime if it exists.
+                self.shard = gzip.open(path, 'xb') if self.compress else open(path, 'xb')
+            except FileExistsError:
+                pass
+            self.shard_idx += 1
+        self.shard_bytes = 0
+
+    def write_row(self, row: dict):
+        if self.shard is None or self.shard_bytes >= self.shard_size:
+            self.close()
+            self._open_shard()
+
+        line = (json.dumps(row) + '\n').encode('utf-8')
+        self.shard.write(line)
+        self.shard_bytes += len(line)
+        # Every turn is readable from the shard as soon as it is written.
+        if self.compress:
+            self.shard.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            self.shard.flush()
+
+    def log_run(self, run_id: str, status: str, params: dict):
+        entry = {'run_id': run_id, 'status': status, 'params': params, 'time': time.time()}
+        # One write per entry, so that the entries of the writers in other processes are never mixed up.
+        fd = os.open(os.path.join(self.output_dir, 'runs.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+        self.runs[run_id] = entry
+
+    def is_finished(self, run_id: str):
+        return run_id in self.runs and self.runs[run_id]['status'] == 'finished'
+
+    def start_run(self, args):
+        return LectureRun(self, make_run_id(args), get_run_params(args))
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+
+
+# The rows and the checkpoints of one lecture.
+class LectureRun:
+    def __init__(self, writer: DatasetWriter, run_id: str, params: dict):
+        self.writer = writer
+        self.run_id = run_id
+        self.params = params
+        self.checkpoint_path = os.path.join(writer.output_dir, 'checkpoints', f"{run_id}.json")
+        self.num_written = 0  # The number of the teacher's messages already written.
+
+        if run_id not in writer.runs:
+            writer.log_run(run_id, 'started', params)
+
+    def load_checkpoint(self):
+        """Returns the state saved after the last finished turn, or None if the lecture has not started yet."""
+        if not os.path.isfile(self.checkpoint_path):
+            return None
+
+        with open(self.checkpoint_path) as f:
+            state = decode_state(f.read())
+        self.num_written = len(state['teacher']['chat_history'])
+        return state
+
+    def save_turn(self, turn: int, history: list[ChatMessage], state: dict):
+        """Appends the new messages of the teacher in this turn and saves the state to resume from."""
+        self.writer.write_row({'run_id': self.run_id, 'turn': turn, 'messages': encode_messages(history[self.num_written:]), 'final': False})
+        self.num_written = len(history)
+
+        # Writing into a temporary file first so that a crash never leaves a broken checkpoint behind.
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(encode_state(state))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def finish(self, turn: int, history: list[ChatMessage]):
+        self.writer.write_row({'run_id': self.run_id, 'turn': turn, 'messages': encode_messages(history[self.num_written:]), 'final': True})
+        self.num_written = len(history)
+        self.writer.log_run(self.run_id, 'finished', self.params)
+
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def load_runs(output_dir: str):
+    """Returns the latest entry of each run in the index."""
+    runs = {}
+    path = os.path.join(output_dir, 'runs.jsonl')
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    runs[entry['run_id']] = entry
+
+    return runs
+
+
+def iter_rows(path: str):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    return  # The last line cut by a crash.
+        except EOFError:
+            return  # The shard of a crashed writer, without the end of the gzip stream.
+
+
+def iter_lectures(output_dir: str):
+    """Streams the finished lectures in the dataset as {'run_id', 'params', 'messages'}, without loading the whole corpus.
+
+    Only the rows of the lectures in progress within the shards are kept in memory.
+    """
+    runs = load_runs(output_dir)
+    pending = {}  # run_id -> turn -> messages
+    for path in sorted(glob.glob(os.path.join(output_dir, 'shards', 'shard-*'))):
+        for row in iter_rows(path):
+            # A turn written again after resuming from an older checkpoint replaces the previous one.
+            pending.setdefault(row['run_id'], {})[row['turn']] = row['messages']
+            if row['final']:
+                turns = pending.pop(row['run_id'])
+                yield {
+                    'run_id': row['run_id'],
+                    'params': runs.get(row['run_id'], {}).get('params'),
+                    'messages': [msg for turn in sorted(turns) for msg in turns[turn]]
+                }
+
+
+if __name__=='__main__':
+    # Converting the dataset back into one JSON file per lecture, as exported by generate_data.py.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, required=True, help="The directory of the sharded dataset.")
+    parser.add_argument('--output_dir', type=str, default='data', help="The directory to export the lectures.")
+
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    num_lectures = 0
+    for lecture in iter_lectures(args.dataset_dir):
+        with open(os.path.join(args.output_dir, f"{lecture['run_id']}.json"), 'w') as f:
+            json.dump(lecture['messages'], f)
+        num_lectures += 1
+
+    print(f"Exported {num_lectures} lectures into {args.output_dir}.")
@@ -0,0 +1,185 @@
+from kani.engines.base import BaseEngine, BaseCompletion
+from kani.engines.openai import OpenAIEngine
+from kani.models import ChatMessage
+from mock_engine import MockEngine
+from scheduler import Scheduler, ScheduledEngine
+from openai import RateLimitError
+
+import logging
+import json
+import os
+
+log = logging.getLogger(__name__)
+
+ROLES = ['teacher', 'student', 'supporter', 'summarizer', 'tutor']
+
+
+def load_api_key(interactive: bool=True):
+    """Reads the OpenAI API key from ``OPENAI_API_KEY``, or from the file in ``OPENAI_API_KEY_FILE`` (e.g. a mounted secret).
+
+    If neither is set, the key is asked on the terminal, or an error is raised if not interactive.
+    """
+    if os.environ.get('OPENAI_API_KEY'):
+        return os.environ['OPENAI_API_KEY']
+    if os.environ.get('OPENAI_API_KEY_FILE'):
+        with open(os.environ['OPENAI_API_KEY_FILE']) as f:
+            return f.read().strip()
+
+    if not interactive:
+        raise RuntimeError("Set OPENAI_API_KEY or OPENAI_API_KEY_FILE to use the OpenAI models.")
+    return input("OpenAI API key: ")
+
+
+# Loading the engine for the given model. 'mock' runs the offline engine without any API key.
+def load_engine(model_idx: str, api_key: str=None, interactive: bool=True, **kwargs):
+    if model_idx == 'mock':
+        return MockEngine(**kwargs)
+
+    if api_key is None:
+        api_key = load_api_key(interactive)
+    return OpenAIEngine(api_key, model=model_idx, **kwargs)
+
+
+def load_scheduled_engine(model_idx: str, api_key: str=None, scheduler: Scheduler=None, interactive: bool=True, **kwargs):
+    # The scheduler retries the failed requests instead of the client of the engine.
+    if model_idx != 'mock':
+        kwargs.setdefault('retry', 0)
+    return ScheduledEngine(load_engine(model_idx, api_key=api_key, interactive=interactive, **kwargs), scheduler)
+
+
+# An engine which moves to the fallback engine when the rate limit is still hit after the retries.
+class FallbackEngine(BaseEngine):
+    def __init__(self, engine: BaseEngine, fallback: BaseEngine):
+        """
+        :param engine: The engine to wrap. It keeps its own HTTP client and connection pool.
+        :param fallback: The engine to send the request to on a rate limit error.
+        """
+        self.engine = engine
+        self.fallback = fallback
+        self.max_context_size = min(engine.max_context_size, fallback.max_context_size)
+
+        self.num_fallbacks = 0
+
+    def __getattr__(self, name):
+        # The model, the hyperparameters and the tokenizer of the wrapped engine.
+        if name == 'engine':
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def message_len(self, message: ChatMessage) -> int:
+        return self.engine.message_len(message)
+
+    def function_token_reserve(self, functions) -> int:
+        return self.engine.function_token_reserve(functions)
+
+    async def predict(self, messages: list[ChatMessage], functions=None, **hyperparams) -> BaseCompletion:
+        try:
+            return await self.engine.predict(messages, functions, **hyperparams)
+        except RateLimitError:
+            self.num_fallbacks += 1
+            log.warning(f"Rate limited on {self.engine.model}, falling back to {self.fallback.model}.")
+            return await self.fallback.predict(messages, functions, **hyperparams)
+
+    async def stream(self, messages: list[ChatMessage], functions=None, **hyperparams):
+        started = False
+        try:
+            async for elem in self.engine.stream(messages, functions, **hyperparams):
+                started = True
+                yield elem
+        except RateLimitError:
+            # The tokens already sent cannot be taken back.
+            if started:
+                raise
+            self.num_fallbacks += 1
+            log.warning(f"Rate limited on {self.engine.model}, falling back to {self.fallback.model}.")
+            async for elem in self.fallback.stream(messages, functions, **hyperparams):
+                yield elem
+
+    async def close(self):
+        # The fallback is closed on its own, since it may be shared by other engines.
+        await self.engine.close()
+
+
+# The engines of the agents by role. The roles without an engine in the config use the default engine.
+class EngineRouter:
+    def __init__(self, default: BaseEngine, engines: dict=None, roles: dict=None):
+        self.default = default
+        self.engines = engines if engines is not None else {}  # name -> engine
+        self.roles = roles if roles is not None else {}  # role -> name
+
+    def get(self, role: str):
+        name = self.roles.get(role)
+        return self.engines[name] if name is not None else self.default
+
+    def all(self):
+        engines = [self.default] if self.default is not None else []
+        for engine in self.engines.values():
+            if all(engine is not e for e in engines):
+                engines.append(engine)
+        return engines
+
+    async def close(self):
+        for engine in self.all():
+            await engine.close()
+
+
+def load_engine_router(model_idx: str, config_path: str=None, interactive: bool=True):
+    """Loads the engines of the roles in the config, or one engine shared by all roles if no config is given.
+
+    The config is a JSON file like:
+        {
+            "engines": {
+                "large": {"model_idx": "gpt-4", "rpm": 500, "tpm": 30000, "max_concurrency": 8, "fallback": "small"},
+                "small": {"model_idx": "gpt-3.5-turbo", "rpm": 3500, "max_concurrency": 32, "temperature": 0.7}
+            },
+            "roles": {"teacher": "large", "summarizer": "large", "student": "small", "supporter": "small", "tutor": "small"}
+        }
+    ``rpm``, ``tpm``, ``max_concurrency`` and ``max_retries`` configure the scheduler of each engine, and the other keys are passed to the engine.
+    The roles not listed use the engine of ``model_idx``.
+    The API key is read by :func:`load_api_key`, which never asks on the terminal if ``interactive`` is False, e.g. in the servers.
+    """
+    if config_path is None:
+        return EngineRouter(load_scheduled_engine(model_idx, interactive=interactive))
+
+    with open(config_path) as f:
+        config = json.load(f)
+    configs, roles = config['engines'], config.get('roles', {})
+    for role, name in roles.items():
+        if role not in ROLES:
+            raise ValueError(f"Unknown role '{role}'. The roles are {ROLES}.")
+        if name not in configs:
+            raise ValueError(f"Unknown engine '{name}' for the role '{role}'.")
+
+    # The API key is asked only once for all engines.
+    api_key = None
+    if any(c['model_idx'] != 'mock' for c in configs.values()) or (len(roles) < len(ROLES) and model_idx != 'mock'):
+        api_key = load_api_key(interactive)
+
+    engines = {}
+    def build(name: str, building: tuple=()):
+        if name in engines:
+            return engines[name]
+        if name in building:
+            raise ValueError(f"The fallbacks of the engine '{name}' form a cycle.")
+
+        kwargs = dict(configs[name])
+        engine_model_idx = kwargs.pop('model_idx')
+        scheduler = Scheduler(
+            rpm=kwargs.pop('rpm', None),
+            tpm=kwargs.pop('tpm', None),
+            max_concurrency=kwargs.pop('max_concurrency', None),
+            max_retries=kwargs.pop('max_retries', 5)
+        )
+        fallback = kwargs.pop('fallback', None)
+
+        engine = load_scheduled_engine(engine_model_idx, api_key=api_key, scheduler=scheduler, **kwargs)
+        if fallback is not None:
+            engine = FallbackEngine(engine, build(fallback, building + (name,)))
+        engines[name] = engine
+        return engine
+
+    for name in configs:
+        build(name)
+
+    default = load_scheduled_engine(model_idx, api_key=api_key) if len(roles) < len(ROLES) else None
+    return EngineRouter(default, engines=engines, roles=roles)
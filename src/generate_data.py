@@ -1,10 +1,15 @@
-from kani.engines.openai import OpenAIEngine
 from kani.models import ChatMessage
 from agent import Participant, Summarizer, Supporter
-from constant import TEACHER_INSTRUCTION, STUDENT_INSTRUCTION, SUPPORTER_INSTRUCTION, SUMMARIZER_INSTRUCTION
+from cache import ResponseCache
+from prefilter import SupportPrefilter
+from context import ContextPolicy
+from engines import EngineRouter, load_engine_router
+from scheduler import priority_scope, BATCH
+from dataset_writer import DatasetWriter, LectureRun
+from metrics import MetricsRecorder, JSONLExporter, recorder
+from prompts import get_system_prompt
 from datetime import datetime
 from pytz import timezone
-from copy import deepcopy
 
 import argparse
 import random
@@ -14,126 +19,235 @@ import json
 
 
 # Main logic for an actual classroom.
-def lecture(args, teacher: Participant, students: Participant, supporter: Supporter, summarizer: Summarizer):
-    async def chat():
-        turn = 0
-        queries = []
-        while (turn < args.max_turns):
-            # Just for first turn.
-            print('-' * 100)
-            if turn == 0:
-                queries = [ChatMessage.user(f"Generate the introduction of today's lecture topic: {args.topic}")]
-                res = await teacher.chat_round_str(queries)
-                teacher.chat_history = teacher.chat_history[1:]
-                queries = []
-            else:
-                res = await teacher.chat_round_str(queries)
-            print(f"Teacher: {res}")
-            print('\n')
-            queries.append(ChatMessage.user(name="Teacher", content=res))
-
-            # Classifying whether there should be additional support.
-            res = await supporter.check_support(deepcopy(queries))
-            if res == 'Yes':
-                extensions = await supporter.generate_support(deepcopy(queries))
-                print(f"System: {extensions}")
-                print('\n')
-
-                better_res = await teacher.chat_round_str([ChatMessage.system(name="Supporter", content=extensions)])
-                print(f"Teacher: {better_res}")
-                print('\n')
-
-                queries.append(ChatMessage.user(name="Teacher", content=better_res))
-            supporter.chat_history.clear()
-
-            student_idxs = list(range(len(students)))
-            chosen_idxs = random.sample(student_idxs, random.randint(1, 2))
-
+async def run_lecture(args, teacher: Participant, students: list[Participant], supporter: Supporter, summarizer: Summarizer, rng=random, verbose=True, run: LectureRun=None):
+    log = print if verbose else (lambda *texts, **kwargs: None)
+
+    turn = 0
+    queries = []
+    if run is not None and (state := run.load_checkpoint()) is not None:
+        turn, queries = load_lecture_state(state, teacher, students, rng)
+        log(f"Resuming the lecture from turn {turn}.")
+
+    while (turn < args.max_turns):
+        # Just for first turn.
+        log('-' * 100)
+        if turn == 0:
+            queries = [ChatMessage.user(f"Generate the introduction of today's lecture topic: {args.topic}")]
+            res = await teacher.chat_round_str(queries)
+            teacher.chat_history = teacher.chat_history[1:]
+            queries = []
+        else:
+            res = await teacher.chat_round_str(queries)
+        log(f"Teacher: {res}")
+        log('\n')
+        queries.append(ChatMessage.user(name="Teacher", content=res))
+
+        # Classifying whether there should be additional support.
+        if args.speculative_support:
+            res, extensions = await supporter.speculate_support(queries)
+        else:
+            res = await supporter.check_support(queries)
+            extensions = await supporter.generate_support(queries) if res == 'Yes' else None
+
+        if res == 'Yes':
+            log(f"System: {extensions}")
+            log('\n')
+
+            better_res = await teacher.chat_round_str([ChatMessage.system(name="Supporter", content=extensions)])
+            log(f"Teacher: {better_res}")
+            log('\n')
+
+            queries.append(ChatMessage.user(name="Teacher", content=better_res))
+        supporter.chat_history.clear()
+
+        student_idxs = list(range(len(students)))
+        chosen_idxs = rng.sample(student_idxs, rng.randint(1, 2))
+
+        if args.simultaneous:
+            # The chosen students answer the same teacher turn at once, and the replies are appended in the sampled order.
+            replies = await asyncio.gather(*[students[idx].chat_round_str(queries) for idx in chosen_idxs])
+            for idx, res in zip(chosen_idxs, replies):
+                log(f"Student {idx+1}: {res}\n")
+                queries.append(ChatMessage.user(name=f"Student-{idx+1}", content=res))
+        else:
             for idx in chosen_idxs:
                 res = await students[idx].chat_round_str(queries)
-                print(f"Student {idx+1}: {res}\n")
+                log(f"Student {idx+1}: {res}\n")
                 queries.append(ChatMessage.user(name=f"Student-{idx+1}", content=res))
 
-            queries = queries[-len(chosen_idxs):]
-            turn += 1
+        queries = queries[-len(chosen_idxs):]
+        turn += 1
+
+        if run is not None:
+            run.save_turn(turn, teacher.chat_history, get_lecture_state(turn, queries, teacher, students, rng))
+
+    res = await teacher.chat_round_str(queries)
+    log(f"Teacher: {res}")
+    log('-' * 100)
+
+    # Summarization of the course.
+    summary = await summarizer.summarize(teacher.get_class_messages(), mode=args.summary_mode)
+    score, main_points, improvements = summary['rate'], summary['main_points'], summary['improvements']
+    log(f"The overall review: {score}")
+    log()
+    log(main_points)
+    log()
+    log(improvements)
+    log()
+
+    await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=score))
+    await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=main_points))
+    await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=improvements))
+
+    if run is not None:
+        run.finish(turn + 1, teacher.chat_history)
+
+    if args.speculative_support:
+        log(f"Speculative support: {supporter.num_wasted} / {supporter.num_speculations} wasted ({supporter.waste_rate:.2%})")
+    log()
+    log(teacher.metrics.report())
+    if supporter.prefilter is not None:
+        prefilter = supporter.prefilter
+        log(f"Support pre-filter: {prefilter.num_escalated} / {prefilter.num_total} escalated ({prefilter.escalation_rate:.2%})")
+
+
+# The state of a lecture after a turn, to resume from its checkpoint. The supporter starts over on every turn.
+def get_lecture_state(turn: int, queries: list[ChatMessage], teacher: Participant, students: list[Participant], rng):
+    return {
+        'turn': turn,
+        'queries': list(queries),
+        'rng': rng.getstate(),
+        'teacher': teacher.get_state(),
+        'students': [student.get_state() for student in students],
+    }
+
 
-        res = await teacher.chat_round_str(queries)
-        print(f"Teacher: {res}")
-        print('-' * 100)
+def load_lecture_state(state: dict, teacher: Participant, students: list[Participant], rng):
+    teacher.set_state(state['teacher'])
+    for student, student_state in zip(students, state['students']):
+        student.set_state(student_state)
 
-        # Summarization of the course.
-        score = await summarizer.rate_class(deepcopy(teacher.chat_history))
-        print(f"The overall review: {score}")
-        print()
-        summarizer.chat_history.clear()
+    version, internal_state, gauss_next = state['rng']
+    rng.setstate((version, tuple(internal_state), gauss_next))
 
-        main_points = await summarizer.generate_points(deepcopy(teacher.chat_history))
-        print(main_points)
-        print()
-        summarizer.chat_history.clear()
+    return state['turn'], state['queries']
 
-        improvements = await summarizer.generate_improvements(deepcopy(teacher.chat_history), main_points)
-        print(improvements)
-        print()
-        summarizer.chat_history.clear()
 
-        await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=score))
-        await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=main_points))
-        await teacher.add_to_history(ChatMessage.system(name='Summarizer', content=improvements))
+def lecture(args, teacher: Participant, students: list[Participant], supporter: Supporter, summarizer: Summarizer, writer: DatasetWriter=None):
+    run = writer.start_run(args) if writer is not None else None
+    if run is not None and writer.is_finished(run.run_id):
+        print(f"The lecture {run.run_id} is already in {writer.output_dir}.")
+        return
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(chat())
+    with priority_scope(BATCH):
+        loop.run_until_complete(run_lecture(args, teacher, students, supporter, summarizer, run=run))
     loop.close()
 
-    # Exporting the data.
-    if not os.path.isdir('data'):
-        os.makedirs('data')
+    # Exporting the data. The dataset already has every turn.
+    if writer is not None:
+        return
+    now = datetime.now(timezone('US/Eastern'))
+    execution_time = now.strftime("%Y-%m-%d-%H-%M-%S")
+    export_logs(teacher.chat_history, get_output_path(args, execution_time=execution_time))
+
+
+# Building the agents of one classroom on top of the (possibly shared) engines of the roles.
+def build_classroom(args, engines: EngineRouter, cache: ResponseCache=None, prefilter: SupportPrefilter=None, metrics: MetricsRecorder=None):
+    # The calls of this lecture are also recorded in the process-wide metrics.
+    metrics = metrics if metrics is not None else MetricsRecorder(parent=recorder)
+    # The lectures with different seeds never share the cached responses, even for the same prompts.
+    cache_scope = f"seed={args.seed}"
+    context_policy = ContextPolicy(max_tokens=args.context_tokens, summary_every=args.summary_every)
+
+    # Teacher Kani.
+    system_prompt = get_system_prompt('teacher', topic=args.topic)
+    teacher = Participant(engine=engines.get('teacher'), system_prompt=system_prompt, name='Teacher', cache=cache, cache_scope=cache_scope, context_policy=context_policy, metrics=metrics)
+
+    # Student Kanis.
+    students = []
+    for s in range(args.num_students):
+        system_prompt = get_system_prompt('student', topic=args.topic)
+        student = Participant(engine=engines.get('student'), system_prompt=system_prompt, name=f"Student-{s+1}", cache=cache, cache_scope=cache_scope, context_policy=context_policy, metrics=metrics)
+        students.append(student)
+
+    # Supporter Kani.
+    system_prompt = get_system_prompt('supporter')
+    supporter = Supporter(engine=engines.get('supporter'), system_prompt=system_prompt, name='Supporter', cache=cache, cache_scope=cache_scope, prefilter=prefilter, metrics=metrics)
+
+    # Summarizer Kani.
+    system_prompt = get_system_prompt('summarizer')
+    summarizer = Summarizer(engine=engines.get('summarizer'), system_prompt=system_prompt, name='Summarizer', cache=cache, cache_scope=cache_scope, metrics=metrics)
+
+    return teacher, students, supporter, summarizer
+
+
+def get_output_path(args, output_dir='data', execution_time=None):
+    file_name = f"seed={args.seed}_model={args.model_idx}_students={args.num_students}_turns={args.max_turns}_topics={args.topic}"
+    if execution_time is not None:
+        file_name += f"_time={execution_time}"
+    return os.path.join(output_dir, f"{file_name}.json")
+
+
+def export_logs(history: list[ChatMessage], path: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
 
-    history = teacher.chat_history
     logs = [{
         'role': msg.role.value,
         'name': msg.name,
         'content': msg.content
     } for msg in history]
 
-    now = datetime.now(timezone('US/Eastern'))
-    execution_time = now.strftime("%Y-%m-%d-%H-%M-%S")
-
-    with open(f"data/seed={args.seed}_model={args.model_idx}_students={args.num_students}_turns={args.max_turns}_topics={args.topic}_time={execution_time}.json", 'w') as f:
+    # Writing into a temporary file first so that a crash never leaves a partial file behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
         json.dump(logs, f)
+    os.replace(tmp_path, path)
+
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', type=int, default=555, help="The random seed.")
-    parser.add_argument('--model_idx', type=str, default='gpt-4', help="The model index to use.")
+    parser.add_argument('--model_idx', type=str, default='gpt-4', help="The model index to use. 'mock' runs the offline engine.")
     parser.add_argument('--num_students', type=int, default=4, help="The number of students in the class.")
     parser.add_argument('--max_turns', type=int, default=20, help="The maximum number of tuns in a chat.")
     parser.add_argument('--topic', type=str, required=True, help="The specific course topic to discuss.")
+    parser.add_argument('--simultaneous', action='store_true', help="Letting the chosen students answer the same teacher turn concurrently.")
+    parser.add_argument('--speculative_support', action='store_true', help="Generating the extensions while checking the support, trading tokens for latency.")
+    parser.add_argument('--summary_mode', type=str, default='serial', choices=['serial', 'concurrent', 'combined'], help="How to generate the rating, the main points and the improvements.")
+    parser.add_argument('--context_tokens', type=int, default=None, help="The token budget of the chat history sent by the teacher and the students. If not set, the whole history is sent.")
+    parser.add_argument('--summary_every', type=int, default=None, help="The number of turns between the refreshes of the rolling summary of the messages out of the budget.")
+    parser.add_argument('--engine_config', type=str, default=None, help="The JSON file assigning an engine to each role. If not set, all agents use the model of --model_idx.")
+    parser.add_argument('--cache_path', type=str, default=None, help="The SQLite file to cache the responses. If not set, the responses are not cached.")
+    parser.add_argument('--prefilter', type=str, default=None, help="The pre-filter trained by prefilter.py to decide the clear support checks locally.")
+    parser.add_argument('--prefilter_threshold', type=float, default=0.9, help="The minimum confidence of the pre-filter to skip the model.")
+    parser.add_argument('--metrics_path', type=str, default=None, help="The JSONL file to append the span of each model call to.")
+    parser.add_argument('--dataset_dir', type=str, default=None, help="The directory of the sharded JSONL dataset to append the turns to. If not set, the lecture is exported as one JSON file.")
+    parser.add_argument('--shard_size', type=int, default=256 * 1024 * 1024, help="The number of bytes in each shard of the dataset.")
+    parser.add_argument('--compress', action='store_true', help="Compressing the shards of the dataset with gzip.")
 
     args = parser.parse_args()
 
     random.seed(args.seed)
-    api_key = input("OpenAI API key: ")
-    engine = OpenAIEngine(api_key, model=args.model_idx)
+    exporter = JSONLExporter(args.metrics_path) if args.metrics_path is not None else None
+    if exporter is not None:
+        recorder.add_hook(exporter)
+    engines = load_engine_router(args.model_idx, args.engine_config)
 
-    # Teacher Kani.
-    system_prompt = ' '.join(TEACHER_INSTRUCTION) + f" The topic is about {args.topic}."
-    teacher = Participant(engine=engine, system_prompt=system_prompt)
+    cache = ResponseCache(args.cache_path) if args.cache_path is not None else None
+    prefilter = SupportPrefilter.load(args.prefilter, threshold=args.prefilter_threshold) if args.prefilter is not None else None
+    teacher, students, supporter, summarizer = build_classroom(args, engines, cache=cache, prefilter=prefilter)
 
-    # Student Kanis.
-    students = []
-    for s in range(args.num_students):
-        system_prompt = ' '.join(STUDENT_INSTRUCTION) + f" The topic is about {args.topic}."
-        student = Participant(engine=engine, system_prompt=system_prompt)
-        students.append(student)
+    writer = DatasetWriter(args.dataset_dir, shard_size=args.shard_size, compress=args.compress) if args.dataset_dir is not None else None
 
-    # Supporter Kani.
-    system_prompt = ' '.join(SUPPORTER_INSTRUCTION)
-    supporter = Supporter(engine=engine, system_prompt=system_prompt)
+    # Main logic.
+    lecture(args, teacher, students, supporter, summarizer, writer=writer)
 
-    # Summarizer Kani.
-    system_prompt = ' '.join(SUMMARIZER_INSTRUCTION)
-    summarizer = Summarizer(engine=engine, system_prompt=system_prompt)
+    if writer is not None:
+        writer.close()
+    if exporter is not None:
+        exporter.close()
 
-    # Main logic.
-    lecture(args, teacher, students, supporter, summarizer)
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+        cache.close()
@@ -0,0 +1,181 @@
+from contextvars import ContextVar
+
+import functools
+import json
+import os
+
+# The USD prices per 1K prompt and completion tokens, matched by the longest prefix of the model name.
+PRICES = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-4-turbo': (0.01, 0.03),
+    'gpt-4o': (0.005, 0.015),
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+}
+
+current_method = ContextVar('method', default=None)
+
+
+def traced(func):
+    """Tags the model calls made in the decorated method of an agent with the name of the method.
+
+    The outermost traced method wins, e.g. the calls in ``check_support`` are not tagged as ``classify_support``.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if current_method.get() is not None:
+            return await func(*args, **kwargs)
+
+        token = current_method.set(func.__name__)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            current_method.reset(token)
+
+    return wrapper
+
+
+def get_role(name: str):
+    # 'Student-1' -> 'student'
+    return name.split('-')[0].lower()
+
+
+def get_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    prefixes = [prefix for prefix in PRICES if model is not None and model.startswith(prefix)]
+    if len(prefixes) == 0:
+        return 0.0
+
+    prompt_price, completion_price = PRICES[max(prefixes, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+# Aggregating the spans of the model calls by role and method, and passing each span to the hooks.
+class MetricsRecorder:
+    def __init__(self, parent: 'MetricsRecorder'=None):
+        """
+        :param parent: The recorder to forward the spans to as well, e.g. the process-wide one from a recorder of one lecture.
+        """
+        self.parent = parent
+        self.hooks = []
+        self.stats = {}  # (role, method) -> aggregated values
+
+    def add_hook(self, hook):
+        """Calls the hook with each span (a dict)."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, span: dict):
+        stats = self.stats.setdefault((span['role'], span['method']), {
+            'calls': 0, 'cached': 0, 'latency': 0.0, 'max_latency': 0.0, 'lock_wait': 0.0,
+            'prompt_tokens': 0, 'completion_tokens': 0, 'prefix_tokens': 0, 'cached_prompt_tokens': 0, 'cost': 0.0,
+        })
+        prompt_tokens, completion_tokens = span['prompt_tokens'] or 0, span['completion_tokens'] or 0
+        stats['calls'] += 1
+        stats['cached'] += int(span['cached'])
+        stats['latency'] += span['latency']
+        stats['max_latency'] = max(stats['max_latency'], span['latency'])
+        stats['lock_wait'] += span['lock_wait']
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+        stats['prefix_tokens'] += span.get('prefix_tokens') or 0
+        stats['cached_prompt_tokens'] += span.get('cached_prompt_tokens') or 0
+        stats['cost'] += get_cost(span['model'], prompt_tokens, completion_tokens)
+
+        for hook in self.hooks:
+            hook(span)
+        if self.parent is not None:
+            self.parent.record(span)
+
+    def summary(self):
+        return [{'role': role, 'method': method, **stats} for (role, method), stats in sorted(self.stats.items())]
+
+    def report(self):
+        """Returns a table of the calls by role and method, sorted by the total latency.
+
+        'prefix' counts the prompt tokens at the start of each prompt already sent in an earlier prompt, which the provider can serve from its prompt cache.
+        """
+        rows = sorted(self.summary(), key=lambda row: row['latency'], reverse=True)
+        total_latency = sum(row['latency'] for row in rows) or 1.0
+
+        lines = [f"{'role':<12}{'method':<24}{'calls':>7}{'cached':>8}{'latency(s)':>12}{'share':>8}{'lock(s)':>9}{'prompt':>9}{'prefix':>9}{'compl.':>8}{'cost($)':>9}"]
+        for row in rows:
+            lines.append(
+                f"{row['role']:<12}{row['method']:<24}{row['calls']:>7}{row['cached']:>8}{row['latency']:>12.2f}{row['latency'] / total_latency:>8.1%}"
+                f"{row['lock_wait']:>9.2f}{row['prompt_tokens']:>9}{row['prefix_tokens']:>9}{row['completion_tokens']:>8}{row['cost']:>9.4f}"
+            )
+        lines.append(
+            f"{'total':<36}{sum(row['calls'] for row in rows):>7}{sum(row['cached'] for row in rows):>8}{sum(row['latency'] for row in rows):>12.2f}{'':>8}"
+            f"{sum(row['lock_wait'] for row in rows):>9.2f}{sum(row['prompt_tokens'] for row in rows):>9}{sum(row['prefix_tokens'] for row in rows):>9}{sum(row['completion_tokens'] for row in rows):>8}{sum(row['cost'] for row in rows):>9.4f}"
+        )
+        return '\n'.join(lines)
+
+    def prometheus(self, gauges: list=None):
+        """Returns the metrics in the Prometheus text format, with the additional gauges as (name, labels, value)."""
+        metrics = [
+            ('classroom_calls_total', 'counter', 'calls'),
+            ('classroom_cached_calls_total', 'counter', 'cached'),
+            ('classroom_latency_seconds_total', 'counter', 'latency'),
+            ('classroom_lock_wait_seconds_total', 'counter', 'lock_wait'),
+            ('classroom_prompt_tokens_total', 'counter', 'prompt_tokens'),
+            ('classroom_completion_tokens_total', 'counter', 'completion_tokens'),
+            ('classroom_prefix_tokens_total', 'counter', 'prefix_tokens'),
+            ('classroom_cached_prompt_tokens_total', 'counter', 'cached_prompt_tokens'),
+            ('classroom_cost_dollars_total', 'counter', 'cost'),
+        ]
+        lines = []
+        for name, metric_type, key in metrics:
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (role, method), stats in sorted(self.stats.items()):
+                lines.append(f'{name}{{role="{role}",method="{method}"}} {stats[key]}')
+
+        typed = set()
+        for name, labels, value in (gauges or []):
+            if name not in typed:
+                lines.append(f"# TYPE {name} gauge")
+                typed.add(name)
+            label_str = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+# The current state of the shared components of a server, as gauges for the /metrics endpoint.
+def collect_gauges(engines=None, prefilter=None, cache=None):
+    gauges = []
+    if engines is not None:
+        for engine in engines.all():
+            if hasattr(engine, 'scheduler'):
+                stats = engine.scheduler.stats()
+                gauges.append(('classroom_scheduler_queue_depth', {'model': engine.model}, stats['queue_depth']))
+                gauges.append(('classroom_scheduler_in_flight', {'model': engine.model}, stats['in_flight']))
+                gauges.append(('classroom_scheduler_retries', {'model': engine.model}, stats['retries']))
+    if prefilter is not None:
+        gauges.append(('classroom_prefilter_checks', {}, prefilter.num_total))
+        gauges.append(('classroom_prefilter_escalated', {}, prefilter.num_escalated))
+        gauges.append(('classroom_prefilter_escalation_rate', {}, prefilter.escalation_rate))
+    if cache is not None:
+        stats = cache.stats()
+        gauges.append(('classroom_cache_hits', {}, stats['hits']))
+        gauges.append(('classroom_cache_misses', {}, stats['misses']))
+
+    return gauges
+
+
+# Appending each span to a JSONL file.
+class JSONLExporter:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def __call__(self, span: dict):
+        self.file.write(json.dumps(span) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# The process-wide recorder, which the agents use unless given their own.
+recorder = MetricsRecorder()
@@ -0,0 +1,116 @@
+from kani.engines.base import BaseEngine, Completion
+from kani.engines.mixins import TokenCached
+from kani.models import ChatMessage, ChatRole
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+
+VOCAB = [
+    "the", "class", "teacher", "student", "question", "answer", "example", "because", "important", "topic",
+    "explain", "more", "about", "how", "why", "what", "think", "understand", "next", "idea",
+    "plant", "energy", "water", "light", "number", "story", "history", "science", "world", "today"
+]
+
+
+# A deterministic stand-in for the OpenAI engine to run the agents without any API key.
+class MockEngine(TokenCached, BaseEngine):
+    def __init__(self, latency: float=0.5, latency_std: float=0.1, token_latency: float=0.0, prompt_latency: float=0.0, min_tokens: int=10, max_tokens: int=40, max_context_size: int=8192, seed: int=0, responses: dict=None):
+        """
+        :param latency: The mean latency of a completion in seconds.
+        :param latency_std: The standard deviation of the latency (normally distributed, clipped at 0).
+        :param token_latency: The additional latency for each generated token in seconds.
+        :param prompt_latency: The additional latency for each prompt token in seconds, spent before the first token.
+        :param min_tokens: The minimum number of tokens in a completion.
+        :param max_tokens: The maximum number of tokens in a completion (uniformly distributed).
+        :param max_context_size: The context size to report to the agents.
+        :param seed: The seed mixed into the hash of each prompt. The same prompt always gets the same completion.
+        :param responses: The fixed responses for the prompts whose task (or last message) contains the key.
+        """
+        super().__init__()
+        self.model = 'mock'
+        self.hyperparams = {}
+        self.latency = latency
+        self.latency_std = latency_std
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.max_context_size = max_context_size
+        self.seed = seed
+        self.responses = responses if responses is not None else {}
+
+    def message_len(self, message: ChatMessage) -> int:
+        # Counted once per message, as the OpenAI engine does.
+        if (cached_len := self.get_cached_message_len(message)) is not None:
+            return cached_len
+
+        # Roughly 4/3 tokens per word, plus the overhead of the message format.
+        text = message.text or ''
+        mlen = len(text.split()) * 4 // 3 + 7
+        self.set_cached_message_len(message, mlen)
+        return mlen
+
+    def _get_rng(self, messages: list[ChatMessage]):
+        prompt = '\n'.join(f"{msg.role.value}:{msg.name}:{msg.text}" for msg in messages)
+        digest = hashlib.sha256(f"{self.seed}\n{prompt}".encode('utf-8')).hexdigest()
+        return random.Random(digest)
+
+    def _get_task(self, messages: list[ChatMessage]):
+        # The instructions of a task are the unnamed system messages after the last answer, around the transcript.
+        # The system prompt of the agent at the start is not a part of the task.
+        start = max([m + 1 for m, msg in enumerate(messages) if msg.role == ChatRole.ASSISTANT], default=1)
+        instructions = [msg.text or '' for msg in messages[start:] if msg.role == ChatRole.SYSTEM and msg.name is None]
+        if len(instructions) > 0:
+            return '\n'.join(instructions)
+        return (messages[-1].text or '') if len(messages) > 0 else ''
+
+    def _generate(self, rng: random.Random, messages: list[ChatMessage]):
+        task = self._get_task(messages)
+        for key, response in self.responses.items():
+            if key in task:
+                return response
+
+        # Structured prompts ask for a JSON object with the listed keys.
+        if 'only in JSON with the keys' in task:
+            keys = re.findall(r"'(\w+)'", task.split('only in JSON with the keys')[-1])
+            return json.dumps({key: self._generate_text(rng) for key in keys})
+
+        # Classification prompts list the options as "0: Yes\n1: No".
+        options = re.findall(r'^(\d+): ', task, flags=re.MULTILINE)
+        if len(options) > 0:
+            return rng.choice(options)
+
+        return self._generate_text(rng)
+
+    def _generate_text(self, rng: random.Random):
+        num_tokens = rng.randint(self.min_tokens, self.max_tokens)
+        return ' '.join(rng.choice(VOCAB) for _ in range(num_tokens)).capitalize() + '.'
+
+    def _prompt_tokens(self, messages: list[ChatMessage]):
+        return sum(self.message_len(msg) for msg in messages)
+
+    async def predict(self, messages: list[ChatMessage], functions=None, **hyperparams) -> Completion:
+        rng = self._get_rng(messages)
+        text = self._generate(rng, messages)
+        num_tokens = len(text.split())
+        prompt_tokens = self._prompt_tokens(messages)
+
+        await asyncio.sleep(max(0.0, rng.gauss(self.latency, self.latency_std)) + self.prompt_latency * prompt_tokens + self.token_latency * num_tokens)
+        return Completion(ChatMessage.assistant(text), prompt_tokens=prompt_tokens, completion_tokens=num_tokens)
+
+    async def stream(self, messages: list[ChatMessage], functions=None, **hyperparams):
+        rng = self._get_rng(messages)
+        text = self._generate(rng, messages)
+        words = text.split(' ')
+        prompt_tokens = self._prompt_tokens(messages)
+
+        # The base latency is spent before the first token.
+        await asyncio.sleep(max(0.0, rng.gauss(self.latency, self.latency_std)) + self.prompt_latency * prompt_tokens)
+        for w, word in enumerate(words):
+            await asyncio.sleep(self.token_latency)
+            yield word if w == 0 else f" {word}"
+
+        yield Completion(ChatMessage.assistant(text), prompt_tokens=prompt_tokens, completion_tokens=len(words))
@@ -0,0 +1,157 @@
+from collections import Counter
+
+import argparse
+import glob
+import math
+import json
+import re
+import os
+
+LABELS = ['Yes', 'No']
+
+
+def tokenize(text: str):
+    return re.findall(r"[a-z0-9']+", (text or '').lower())
+
+
+# The support decisions recorded in an exported lecture of generate_data.py.
+# A teacher utterance is labeled 'Yes' if the supporter's extensions follow it, and 'No' if the students answer it directly.
+def extract_examples(logs: list[dict]):
+    examples = []
+    for l, log in enumerate(logs[:-1]):
+        if log['role'] != 'assistant':
+            continue
+        # The revised answer after the support is never checked again.
+        if l > 0 and logs[l-1]['role'] == 'system' and logs[l-1]['name'] == 'Supporter':
+            continue
+
+        next_log = logs[l+1]
+        if next_log['role'] == 'system' and next_log['name'] == 'Supporter':
+            examples.append((log['content'], 'Yes'))
+        elif next_log['role'] == 'user':
+            examples.append((log['content'], 'No'))
+
+    return examples
+
+
+def load_examples(data_dir: str='data'):
+    examples = []
+    for path in sorted(glob.glob(os.path.join(data_dir, '**', '*.json'), recursive=True)):
+        with open(path) as f:
+            examples += extract_examples(json.load(f))
+
+    return examples
+
+
+# Naive Bayes classifier on the words of the teacher's utterance, which decides the clear cases before the supporter is asked.
+class SupportPrefilter:
+    def __init__(self, threshold: float=0.9, alpha: float=1.0):
+        """
+        :param threshold: The minimum probability of a decision made locally. Below this, the decision is escalated to the model.
+        :param alpha: The additive smoothing of the word counts.
+        """
+        self.threshold = threshold
+        self.alpha = alpha
+
+        self.label_counts = {label: 0 for label in LABELS}
+        self.word_counts = {label: Counter() for label in LABELS}
+
+        # The statistics of the decisions.
+        self.num_total = 0
+        self.num_escalated = 0
+
+    def fit(self, examples: list[tuple[str, str]]):
+        for text, label in examples:
+            self.label_counts[label] += 1
+            self.word_counts[label].update(tokenize(text))
+        return self
+
+    def predict_proba(self, text: str):
+        """Returns the probability of 'Yes', or None if the classifier has not seen both labels."""
+        if any(count == 0 for count in self.label_counts.values()):
+            return None
+
+        vocab_size = len(set(self.word_counts['Yes']) | set(self.word_counts['No']))
+        num_examples = sum(self.label_counts.values())
+        scores = {}
+        for label in LABELS:
+            total = sum(self.word_counts[label].values())
+            score = math.log(self.label_counts[label] / num_examples)
+            for word in tokenize(text):
+                score += math.log((self.word_counts[label][word] + self.alpha) / (total + self.alpha * vocab_size))
+            scores[label] = score
+
+        return 1.0 / (1.0 + math.exp(min(scores['No'] - scores['Yes'], 700.0)))
+
+    def decide(self, text: str):
+        """Returns the decision with its probability, or (None, None) if it is not confident enough."""
+        prob = self.predict_proba(text)
+        if prob is not None:
+            if prob >= self.threshold:
+                return 'Yes', prob
+            if 1.0 - prob >= self.threshold:
+                return 'No', 1.0 - prob
+
+        return None, None
+
+    def predict(self, text: str):
+        """Like :meth:`decide`, but counted in the statistics. (None, None) means the decision is escalated to the model."""
+        res, prob = self.decide(text)
+        self.num_total += 1
+        if res is None:
+            self.num_escalated += 1
+        return res, prob
+
+    @property
+    def escalation_rate(self):
+        if self.num_total == 0:
+            return 0.0
+        return self.num_escalated / self.num_total
+
+    def stats(self):
+        return {'total': self.num_total, 'escalated': self.num_escalated, 'escalation_rate': self.escalation_rate}
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'alpha': self.alpha,
+                'label_counts': self.label_counts,
+                'word_counts': {label: dict(counts) for label, counts in self.word_counts.items()}
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, threshold: float=0.9):
+        with open(path) as f:
+            params = json.load(f)
+
+        prefilter = cls(threshold=threshold, alpha=params['alpha'])
+        prefilter.label_counts = params['label_counts']
+        prefilter.word_counts = {label: Counter(counts) for label, counts in params['word_counts'].items()}
+        return prefilter
+
+
+if __name__=='__main__':
+    # Training the pre-filter from the lectures exported by generate_data.py.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data', help="The directory of the exported lectures.")
+    parser.add_argument('--output', type=str, default='cache/prefilter.json', help="The JSON file to save the pre-filter.")
+    parser.add_argument('--threshold', type=float, default=0.9, help="The confidence threshold to report the escalation rate on the training data.")
+
+    args = parser.parse_args()
+
+    examples = load_examples(args.data_dir)
+    prefilter = SupportPrefilter(threshold=args.threshold).fit(examples)
+    prefilter.save(args.output)
+
+    num_correct = 0
+    num_decided = 0
+    for text, label in examples:
+        decision, _ = prefilter.predict(text)
+        if decision is not None:
+            num_decided += 1
+            num_correct += int(decision == label)
+
+    print(f"Trained on {len(examples)} utterances ({prefilter.label_counts['Yes']} Yes / {prefilter.label_counts['No']} No).")
+    print(f"Escalated: {prefilter.num_escalated} / {prefilter.num_total}, accuracy of the local decisions: {num_correct} / {num_decided}")
+    print(f"Saved the pre-filter in {args.output}.")
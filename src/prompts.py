@@ -0,0 +1,81 @@
+from kani.models import ChatMessage
+from constant import TEACHER_INSTRUCTION, STUDENT_INSTRUCTION, SUPPORTER_INSTRUCTION, SUMMARIZER_INSTRUCTION, PERSONALIZED_INSTRUCTION
+from typing import Callable, Sequence
+
+import itertools
+
+# The system prompts of the roles, joined once.
+SYSTEM_PROMPTS = {
+    'teacher': ' '.join(TEACHER_INSTRUCTION),
+    'student': ' '.join(STUDENT_INSTRUCTION),
+    'supporter': ' '.join(SUPPORTER_INSTRUCTION),
+    'summarizer': ' '.join(SUMMARIZER_INSTRUCTION),
+    'tutor': ' '.join(PERSONALIZED_INSTRUCTION),
+}
+
+SUPPORT_OPTIONS = ['Yes', 'No']
+
+# The fixed instructions of the tasks, sent before the transcript so that every call of a task starts with the same messages,
+# or right after it for the summarizer, whose tasks share the transcript.
+# The same objects are shared by all prompts, so their token lengths are counted only once.
+CHECK_SUPPORT = ChatMessage.system(content="Given the following interaction, do you think the teacher's last answer needs some support or not? You should answer only in number.\n\n" + '\n'.join([f"{o}: {option}" for o, option in enumerate(SUPPORT_OPTIONS)]))
+GENERATE_SUPPORT = ChatMessage.system(content="Given the following interaction, suggest about 2-3 additional subtopics or extensions you think useful for the teacher to help the students understand better.\n\nYour answer should start with: 'It might be great to explain more about...' and then the list of suggestions.")
+RATE_CLASS = ChatMessage.system(content="Rate the overall quality of the lecture in terms of the quality of the content and how detailed and understandable the teacher's explanation is. You should generate the score between 1 to 10 and a brief reason in one sentence.")
+GENERATE_POINTS = ChatMessage.system(content="Generate 2-3 essential subtopics or contents during the class. These could be the ones which most students were curious about or which you think as the important contents to refer to for improving the course quality in the future. Your answer should start with: 'The main points of today's class: ' and then the list of contents. Each item should be as simple as possible.")
+GENERATE_IMPROVEMENTS = ChatMessage.system(content="Generate your recommendation to the teacher so that the course quality can be improve next time based on the main points of the class suggested below. You should only give recommendations without any additional ratings or repetition of main points.")
+GENERATE_SUMMARY = ChatMessage.system(content="Wrap up the lecture in three parts. First, rate the overall quality of the lecture in terms of the quality of the content and how detailed and understandable the teacher's explanation is, with the score between 1 to 10 and a brief reason in one sentence. Second, generate 2-3 essential subtopics or contents during the class, which most students were curious about or which you think as the important contents to refer to for improving the course quality in the future. This part should start with: 'The main points of today's class: ' and then the list of contents. Finally, generate your recommendation to the teacher so that the course quality can be improve next time based on the main points, without any additional ratings or repetition of main points.\n\nYou should answer only in JSON with the keys 'rate', 'main_points' and 'improvements', whose values are strings.")
+EXTRACT_TOPIC = ChatMessage.system(content="Generate one topic word from the following class which would be most helpful to the student described after the class. If there is none, just generate 'None'.")
+EXPLAIN_ARTICLE = ChatMessage.system(content="Generate the summarization of the following article in 2-3 sentences to help the student.")
+
+
+def get_system_prompt(role: str, topic: str=None):
+    prompt = SYSTEM_PROMPTS[role]
+    if topic is None:
+        return prompt
+    return f"{prompt} The topic is about {topic}."
+
+
+def build_prompt(instruction: ChatMessage, queries: Sequence[ChatMessage]=(), tail: str=None, shared_transcript: bool=False):
+    """Returns the messages of a task: the fixed instruction, the transcript, and then the parts of the task which vary by call.
+
+    :param shared_transcript: Putting the transcript before the instruction, when several tasks run on the same transcript
+        (e.g. the rating, the main points and the improvements), so that the longer prefix is shared by all of them.
+    """
+    messages = [*queries, instruction] if shared_transcript else [instruction, *queries]
+    if tail is not None:
+        messages.append(ChatMessage.system(content=tail))
+    return messages
+
+
+# The prompts already sent to each model, to measure the prefix of a new prompt which the provider can serve from its prompt cache.
+# Each prefix is kept as a running hash over its messages, so a prompt is checked in one pass regardless of which agent sent it.
+class PrefixTracker:
+    def __init__(self, max_entries: int=16384):
+        """
+        :param max_entries: The number of prefixes to remember. The least recently used ones are forgotten first.
+        """
+        self.seen = {}  # hash of a prefix -> None, the least recently used first
+        self.max_entries = max_entries
+
+    def observe(self, model: str, prompt: list[ChatMessage], token_len: Callable[[ChatMessage], int]):
+        """Returns the number of tokens at the start of the prompt which were already sent to the model in an earlier prompt,
+        and the number of tokens of the whole prompt."""
+        num_tokens, prefix_tokens, matched = 0, 0, True
+        h = hash(model)
+        for msg in prompt:
+            content = msg.content if isinstance(msg.content, str) else msg.text  # The parts of a message are not hashable.
+            h = hash((h, id(msg.role), msg.name, content))
+            num_tokens += token_len(msg)
+            if matched and self.seen.pop(h, False) is None:
+                prefix_tokens = num_tokens
+            else:
+                matched = False
+            self.seen[h] = None
+
+        for h in list(itertools.islice(self.seen, max(0, len(self.seen) - self.max_entries))):
+            del self.seen[h]
+        return prefix_tokens, num_tokens
+
+
+# The process-wide tracker, shared by all agents.
+prefixes = PrefixTracker()
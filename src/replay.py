@@ -0,0 +1,229 @@
+from kani.models import ChatMessage, ChatRole
+from agent import Supporter, Summarizer
+from cache import ResponseCache
+from prefilter import SupportPrefilter
+from engines import EngineRouter, load_engine_router
+from scheduler import priority_scope, BATCH
+from dataset_writer import iter_lectures
+from metrics import recorder
+from prompts import get_system_prompt
+
+import argparse
+import asyncio
+import glob
+import json
+import re
+import os
+
+AGENTS = ['supporter', 'summarizer']
+
+
+def decode_messages(logs: list[dict]):
+    # The reverse of export_logs in generate_data.py.
+    return [ChatMessage(role=ChatRole(log['role']), name=log['name'], content=log['content']) for log in logs]
+
+
+# The support checks made in a recorded lecture, as they were sent to the supporter by run_lecture in generate_data.py.
+# Each check has the students' messages since the previous answer of the teacher, followed by the answer.
+def extract_support_checks(messages: list[ChatMessage]):
+    checks = []
+    students = []
+    for m, msg in enumerate(messages):
+        if msg.role == ChatRole.USER:
+            students.append(msg)
+            continue
+        if msg.role != ChatRole.ASSISTANT:
+            continue
+        # The revised answer after the support is never checked again.
+        if m > 0 and messages[m-1].role == ChatRole.SYSTEM and messages[m-1].name == 'Supporter':
+            continue
+
+        next_msg = messages[m+1] if m+1 < len(messages) else None
+        if next_msg is not None and next_msg.role == ChatRole.SYSTEM and next_msg.name == 'Supporter':
+            recorded, extensions = 'Yes', next_msg.content
+        elif next_msg is not None and next_msg.role == ChatRole.USER:
+            recorded, extensions = 'No', None
+        else:
+            break  # The last answer of the teacher goes to the summarizer without any check.
+
+        checks.append({
+            'queries': students + [ChatMessage.user(name='Teacher', content=msg.content)],
+            'recorded': recorded,
+            'recorded_extensions': extensions
+        })
+        students = []
+
+    return checks
+
+
+def split_summary(messages: list[ChatMessage]):
+    """Returns the transcript given to the summarizer, and the recorded rating, main points and improvements."""
+    transcript = [msg for msg in messages if not (msg.role == ChatRole.SYSTEM and msg.name == 'Summarizer')]
+    summary = [msg.content for msg in messages if msg.role == ChatRole.SYSTEM and msg.name == 'Summarizer']
+    recorded = dict(zip(['rate', 'main_points', 'improvements'], summary)) if len(summary) == 3 else None
+
+    return transcript, recorded
+
+
+def get_score(rate: str):
+    # The first number in the rating, e.g. 'Score: 8/10. ...' -> 8.
+    matches = re.findall(r'\d+(?:\.\d+)?', rate or '')
+    return float(matches[0]) if len(matches) > 0 else None
+
+
+# Loading the recorded lectures lazily, either from the JSON files of generate_data.py or from a sharded dataset.
+def iter_recorded(data_dir: str=None, dataset_dir: str=None):
+    if dataset_dir is not None:
+        for lecture in iter_lectures(dataset_dir):
+            yield lecture['run_id'], lecture['messages']
+        return
+
+    for path in sorted(glob.glob(os.path.join(data_dir, '**', '*.json'), recursive=True)):
+        with open(path) as f:
+            yield path, json.load(f)
+
+
+async def replay_support(supporter: Supporter, check: dict):
+    # The supporter starts over on every turn, as in run_lecture.
+    supporter = supporter.fork([])
+    res = await supporter.check_support(check['queries'])
+    extensions = await supporter.generate_support(check['queries']) if res == 'Yes' else None
+
+    return {'recorded': check['recorded'], 'replayed': res, 'recorded_extensions': check['recorded_extensions'], 'extensions': extensions}
+
+
+async def replay_lecture(lecture_id: str, logs: list[dict], supporter: Supporter=None, summarizer: Summarizer=None, summary_mode: str='serial'):
+    """Re-runs the given agents on the fixed turns of a recorded lecture. The support checks of all turns run at once."""
+    messages = decode_messages(logs)
+    result = {'lecture': lecture_id}
+
+    tasks = []
+    if supporter is not None:
+        tasks += [replay_support(supporter, check) for check in extract_support_checks(messages)]
+    if summarizer is not None:
+        transcript, recorded = split_summary(messages)
+        tasks.append(summarizer.summarize(transcript, mode=summary_mode))
+
+    outputs = await asyncio.gather(*tasks)
+    if summarizer is not None:
+        result['summary'] = {'recorded': recorded, 'replayed': outputs[-1]}
+        outputs = outputs[:-1]
+    if supporter is not None:
+        result['support'] = [{'turn': t, **output} for t, output in enumerate(outputs)]
+
+    return result
+
+
+# The agreement between the recorded and the replayed decisions, and the change of the rating scores.
+class ReplayStats:
+    def __init__(self):
+        self.num_lectures = 0
+        self.num_checks = 0
+        self.num_agreed = 0
+        self.num_recorded_yes = 0
+        self.num_replayed_yes = 0
+        self.score_diffs = []
+
+    def update(self, result: dict):
+        self.num_lectures += 1
+        for check in result.get('support', []):
+            self.num_checks += 1
+            self.num_agreed += int(check['recorded'] == check['replayed'])
+            self.num_recorded_yes += int(check['recorded'] == 'Yes')
+            self.num_replayed_yes += int(check['replayed'] == 'Yes')
+
+        if 'summary' in result and result['summary']['recorded'] is not None:
+            recorded, replayed = get_score(result['summary']['recorded']['rate']), get_score(result['summary']['replayed']['rate'])
+            if recorded is not None and replayed is not None:
+                self.score_diffs.append(replayed - recorded)
+
+    def report(self):
+        lines = [f"Lectures: {self.num_lectures}"]
+        if self.num_checks > 0:
+            lines.append(f"Support checks: {self.num_agreed} / {self.num_checks} agreed ({self.num_agreed / self.num_checks:.2%}), 'Yes' {self.num_recorded_yes} -> {self.num_replayed_yes}")
+        if len(self.score_diffs) > 0:
+            lines.append(f"Rating: {sum(self.score_diffs) / len(self.score_diffs):+.2f} on average over {len(self.score_diffs)} lectures")
+        return '\n'.join(lines)
+
+
+async def run_replay(lectures, supporter: Supporter=None, summarizer: Summarizer=None, summary_mode: str='serial', concurrency: int=8, output_path: str=None, engines: EngineRouter=None):
+    """Replays the lectures with at most ``concurrency`` of them in flight, writing each result as soon as it is done."""
+    stats = ReplayStats()
+    output = open(output_path, 'w') if output_path is not None else None
+
+    def _collect(task):
+        result = task.result()
+        stats.update(result)
+        if output is not None:
+            output.write(json.dumps(result) + '\n')
+
+    pending = set()
+    try:
+        # The lectures are read only when there is room for them, so that a large corpus is never loaded at once.
+        with priority_scope(BATCH):
+            for lecture_id, logs in lectures:
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        _collect(task)
+                pending.add(asyncio.create_task(replay_lecture(lecture_id, logs, supporter=supporter, summarizer=summarizer, summary_mode=summary_mode)))
+
+            if len(pending) > 0:
+                done, _ = await asyncio.wait(pending)
+                for task in done:
+                    _collect(task)
+    finally:
+        if output is not None:
+            output.close()
+        if engines is not None:
+            await engines.close()
+
+    return stats
+
+
+def load_prompt(path: str, role: str):
+    if path is None:
+        return get_system_prompt(role)
+    with open(path) as f:
+        return f.read().strip()
+
+
+if __name__=='__main__':
+    # Re-running only the selected agents on the recorded lectures, e.g. to evaluate a new prompt or model of the supporter.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data', help="The directory of the lectures exported by generate_data.py.")
+    parser.add_argument('--dataset_dir', type=str, default=None, help="The directory of a sharded dataset to replay instead of --data_dir.")
+    parser.add_argument('--agents', type=str, nargs='+', default=AGENTS, choices=AGENTS, help="The agents to re-run on the recorded turns.")
+    parser.add_argument('--model_idx', type=str, default='gpt-4', help="The model index to use. 'mock' runs the offline engine.")
+    parser.add_argument('--engine_config', type=str, default=None, help="The JSON file assigning an engine to each role. If not set, all agents use the model of --model_idx.")
+    parser.add_argument('--supporter_prompt', type=str, default=None, help="The text file of the system prompt of the supporter. If not set, the current one is used.")
+    parser.add_argument('--summarizer_prompt', type=str, default=None, help="The text file of the system prompt of the summarizer. If not set, the current one is used.")
+    parser.add_argument('--summary_mode', type=str, default='serial', choices=['serial', 'concurrent', 'combined'], help="How to generate the rating, the main points and the improvements.")
+    parser.add_argument('--prefilter', type=str, default=None, help="The pre-filter trained by prefilter.py to decide the clear support checks locally.")
+    parser.add_argument('--prefilter_threshold', type=float, default=0.9, help="The minimum confidence of the pre-filter to skip the model.")
+    parser.add_argument('--cache_path', type=str, default=None, help="The SQLite file to cache the responses. The unchanged agents are answered from it.")
+    parser.add_argument('--concurrency', type=int, default=8, help="The maximum number of lectures replayed at once.")
+    parser.add_argument('--output', type=str, default=None, help="The JSONL file to write the replayed decisions and summaries of each lecture.")
+
+    args = parser.parse_args()
+
+    engines = load_engine_router(args.model_idx, args.engine_config)
+    cache = ResponseCache(args.cache_path) if args.cache_path is not None else None
+    prefilter = SupportPrefilter.load(args.prefilter, threshold=args.prefilter_threshold) if args.prefilter is not None else None
+
+    supporter, summarizer = None, None
+    if 'supporter' in args.agents:
+        supporter = Supporter(engine=engines.get('supporter'), system_prompt=load_prompt(args.supporter_prompt, 'supporter'), name='Supporter', cache=cache, prefilter=prefilter)
+    if 'summarizer' in args.agents:
+        summarizer = Summarizer(engine=engines.get('summarizer'), system_prompt=load_prompt(args.summarizer_prompt, 'summarizer'), name='Summarizer', cache=cache)
+
+    lectures = iter_recorded(data_dir=args.data_dir, dataset_dir=args.dataset_dir)
+    stats = asyncio.run(run_replay(lectures, supporter=supporter, summarizer=summarizer, summary_mode=args.summary_mode, concurrency=args.concurrency, output_path=args.output, engines=engines))
+
+    print(stats.report())
+    print(recorder.report())
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+        cache.close()
+    if prefilter is not None:
+        print(f"Support pre-filter: {prefilter.stats()}")
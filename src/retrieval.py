@@ -0,0 +1,173 @@
+from kani.engines.httpclient import BaseClient
+from cache import TTLCache
+
+import argparse
+import asyncio
+import sqlite3
+import json
+import os
+
+MISSING = object()
+
+
+class WikiClient(BaseClient):
+    SERVICE_BASE = "https://en.wikipedia.org/w/api.php"
+
+
+# Offline article store in SQLite with a full-text index, built from a dump of (title, text).
+class LocalArticleStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, content TEXT NOT NULL)")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(title, content, content='pages')")
+        self.conn.commit()
+
+    def add(self, title: str, content: str):
+        cursor = self.conn.execute("INSERT OR IGNORE INTO pages (title, content) VALUES (?, ?)", (title, content))
+        if cursor.rowcount > 0:
+            self.conn.execute("INSERT INTO pages_fts (rowid, title, content) VALUES (?, ?, ?)", (cursor.lastrowid, title, content))
+
+    def search(self, query: str, limit: int=10):
+        # Quoting each word so that the query is never parsed as the FTS syntax.
+        words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+        if len(words) == 0:
+            return []
+
+        rows = self.conn.execute(
+            "SELECT title FROM pages_fts WHERE pages_fts MATCH ? ORDER BY rank LIMIT ?",
+            (' '.join(words), limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, title: str):
+        row = self.conn.execute("SELECT content FROM pages WHERE title = ?", (title,)).fetchone()
+        return row[0] if row is not None else None
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# Cached Wikipedia lookups shared by the personalized tutors.
+# Concurrent lookups of the same key share one fetch, and the local store is used instead of the API if given.
+class WikiRetriever:
+    def __init__(self, client: WikiClient=None, max_entries: int=1024, ttl: float=3600, local_store: LocalArticleStore=None):
+        self.client = client if client is not None else WikiClient()
+        self.local_store = local_store
+        self.search_cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.content_cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.inflight = {}  # key -> the task fetching it
+
+        self.num_coalesced = 0
+
+    async def _get_cached(self, cache: TTLCache, key, fetch):
+        value = cache.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        if key in self.inflight:
+            self.num_coalesced += 1
+            return await asyncio.shield(self.inflight[key])
+
+        task = asyncio.ensure_future(fetch())
+        self.inflight[key] = task
+        try:
+            value = await asyncio.shield(task)
+            cache.put(key, value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    async def search_articles(self, query: str):
+        """Returns the titles of the articles matching the query."""
+        async def _fetch():
+            if self.local_store is not None:
+                return self.local_store.search(query)
+
+            resp = await self.client.get(
+                "/",
+                params={"action": "opensearch", "format": "json", "search": query}
+            )
+            return resp[1]
+
+        return await self._get_cached(self.search_cache, ('search', query.strip().lower()), _fetch)
+
+    async def search_content(self, title: str):
+        """Returns the plain text extract of the article, or None if it is empty."""
+        async def _fetch():
+            if self.local_store is not None:
+                return self.local_store.get(title)
+
+            resp = await self.client.get(
+                "/",
+                params={
+                    "action": "query",
+                    "format": "json",
+                    "prop": "extracts",
+                    "titles": title,
+                    "explaintext": 1,
+                    "formatversion": 2,
+                },
+            )
+            page = resp["query"]["pages"][0]
+            return page.get("extract") or None
+
+        return await self._get_cached(self.content_cache, ('content', title), _fetch)
+
+    async def find_article(self, query: str, top_k: int=3):
+        """Returns the (title, extract) of the best matching article with a non-empty extract, or None.
+
+        The extracts of the top-k candidates are fetched at once.
+        """
+        titles = await self.search_articles(query)
+        if titles is None or len(titles) == 0:
+            return None
+
+        contents = await asyncio.gather(*[self.search_content(title) for title in titles[:top_k]])
+        for title, content in zip(titles, contents):
+            if content is not None:
+                return title, content
+
+        return None
+
+    def stats(self):
+        return {
+            'search': self.search_cache.stats(),
+            'content': self.content_cache.stats(),
+            'coalesced': self.num_coalesced,
+        }
+
+    async def close(self):
+        await self.client.close()
+        if self.local_store is not None:
+            self.local_store.close()
+
+
+if __name__=='__main__':
+    # Building the local article store from a JSONL dump, where each line has 'title' and 'text' (e.g. the output of WikiExtractor).
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dump', type=str, required=True, help="The JSONL dump of the articles.")
+    parser.add_argument('--output', type=str, default='cache/wiki.db', help="The SQLite file of the local article store.")
+
+    args = parser.parse_args()
+
+    store = LocalArticleStore(args.output)
+    num_articles = 0
+    with open(args.dump) as f:
+        for line in f:
+            article = json.loads(line)
+            if len(article.get('text', '').strip()) == 0:
+                continue
+            store.add(article['title'], article['text'])
+            num_articles += 1
+            if num_articles % 10000 == 0:
+                store.commit()
+    store.commit()
+    store.close()
+
+    print(f"Stored {num_articles} articles in {args.output}.")
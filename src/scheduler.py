@@ -0,0 +1,274 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from kani.engines.base import BaseEngine, BaseCompletion
+from kani.models import ChatMessage
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+
+import itertools
+import asyncio
+import logging
+import random
+import heapq
+import time
+
+log = logging.getLogger(__name__)
+
+# The priority classes. The lower one is dispatched first, among the requests of the same process.
+INTERACTIVE = 0
+BATCH = 1
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, asyncio.TimeoutError)
+DEFAULT_COMPLETION_TOKENS = 256  # The completion tokens expected when max_tokens is not set.
+
+current_priority = ContextVar('priority', default=INTERACTIVE)
+current_prompt_tokens = ContextVar('prompt_tokens', default=None)  # The tokens of the prompt if already counted by the caller.
+
+
+@contextmanager
+def priority_scope(priority: int):
+    """Runs the requests made in this block, including the tasks started in it, with the given priority."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+@contextmanager
+def prompt_tokens_scope(num_tokens: int):
+    """Estimates the prompts of the requests made in this block with the given number of tokens instead of counting them again."""
+    token = current_prompt_tokens.set(num_tokens)
+    try:
+        yield
+    finally:
+        current_prompt_tokens.reset(token)
+
+
+# Tokens refilled at a constant rate per minute, up to one minute of burst.
+class TokenBucket:
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float):
+        # The level can go below zero when the actual usage is more than estimated.
+        self._refill()
+        self.level -= amount
+
+
+# Dispatching the requests of an engine by priority within the rate limits, and retrying the transient errors.
+# The queue and the rate limits are those of one process. The other processes using the same API key are not counted.
+class Scheduler:
+    def __init__(self, rpm: float=None, tpm: float=None, max_concurrency: int=None, max_retries: int=5, base_delay: float=1.0, max_delay: float=60.0):
+        """
+        :param rpm: The requests per minute. If None, it is not limited.
+        :param tpm: The tokens per minute, counting the prompt and the completion. If None, it is not limited.
+        :param max_concurrency: The maximum number of requests in flight. If None, it is not limited.
+        :param max_retries: The number of retries of a request failed by a rate limit, a timeout or a server error.
+        :param base_delay: The backoff before the first retry in seconds, doubled for each retry with a random jitter.
+        :param max_delay: The maximum backoff in seconds.
+        """
+        self.request_bucket = TokenBucket(rpm) if rpm is not None else None
+        self.token_bucket = TokenBucket(tpm) if tpm is not None else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.queue = []  # (priority, sequence, tokens, future)
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.paused_until = 0.0  # Every request waits until then after a rate limit error.
+        self.timer = None
+
+        # The statistics of the requests.
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_failed = 0
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, _, future in self.queue if not future.done())
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'requests': self.num_requests,
+            'retries': self.num_retries,
+            'failed': self.num_failed,
+        }
+
+    def _dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        while len(self.queue) > 0:
+            _, _, tokens, future = self.queue[0]
+            if future.done():
+                # Cancelled while waiting.
+                heapq.heappop(self.queue)
+                continue
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                return  # Dispatched again when a request is released.
+
+            wait = max(
+                self.paused_until - time.monotonic(),
+                self.request_bucket.time_until(1) if self.request_bucket is not None else 0.0,
+                self.token_bucket.time_until(tokens) if self.token_bucket is not None else 0.0
+            )
+            if wait > 0:
+                self.timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            heapq.heappop(self.queue)
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, tokens: int, priority: int=None):
+        """Waits until the request with the estimated tokens can be sent. It must be released after the request."""
+        priority = current_priority.get() if priority is None else priority
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.sequence), tokens, future))
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self, tokens: int=None, used_tokens: int=None):
+        """Frees the slot of a request, correcting the token bucket with the actual usage if known."""
+        self.in_flight -= 1
+        if self.token_bucket is not None and tokens is not None and used_tokens is not None:
+            self.token_bucket.consume(used_tokens - tokens)
+        self._dispatch()
+
+    def get_delay(self, error: Exception, attempt: int):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        if isinstance(error, RateLimitError):
+            # Following the server if it tells when to retry, and holding back all requests until then.
+            retry_after = error.response.headers.get('retry-after') if error.response is not None else None
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+        return delay
+
+    async def run(self, request, tokens: int):
+        """Sends the request (a function returning an awaitable) in its turn, retrying on the transient errors."""
+        self.num_requests += 1
+        for attempt in itertools.count():
+            await self.acquire(tokens)
+            used_tokens = None
+            try:
+                completion = await request()
+                used_tokens = get_used_tokens(completion)
+                return completion
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    self.num_failed += 1
+                    raise
+                delay = self.get_delay(e, attempt)
+                self.num_retries += 1
+                log.warning(f"{type(e).__name__} on attempt {attempt+1}, retrying in {delay:.1f}s.")
+            finally:
+                self.release(tokens, used_tokens)
+
+            await asyncio.sleep(delay)
+
+
+def get_used_tokens(completion: BaseCompletion):
+    if completion.prompt_tokens is None or completion.completion_tokens is None:
+        return None
+    return completion.prompt_tokens + completion.completion_tokens
+
+
+# An engine whose requests go through the scheduler.
+class ScheduledEngine(BaseEngine):
+    def __init__(self, engine: BaseEngine, scheduler: Scheduler=None):
+        self.engine = engine
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.max_context_size = engine.max_context_size
+
+    def __getattr__(self, name):
+        # The model, the hyperparameters and the tokenizer of the wrapped engine.
+        if name == 'engine':
+            raise AttributeError(name)
+        return getattr(self.engine, name)
+
+    def message_len(self, message: ChatMessage) -> int:
+        return self.engine.message_len(message)
+
+    def function_token_reserve(self, functions) -> int:
+        return self.engine.function_token_reserve(functions)
+
+    def estimate_tokens(self, messages: list[ChatMessage], hyperparams: dict):
+        # The tokens are needed only for the token bucket.
+        if self.scheduler.token_bucket is None:
+            return None
+        max_tokens = hyperparams.get('max_tokens', getattr(self.engine, 'hyperparams', {}).get('max_tokens', DEFAULT_COMPLETION_TOKENS))
+        prompt_tokens = current_prompt_tokens.get()
+        if prompt_tokens is None:
+            prompt_tokens = sum(self.engine.message_len(msg) for msg in messages)
+        return prompt_tokens + max_tokens
+
+    async def predict(self, messages: list[ChatMessage], functions=None, **hyperparams) -> BaseCompletion:
+        return await self.scheduler.run(
+            lambda: self.engine.predict(messages, functions, **hyperparams),
+            self.estimate_tokens(messages, hyperparams)
+        )
+
+    async def stream(self, messages: list[ChatMessage], functions=None, **hyperparams):
+        scheduler = self.scheduler
+        tokens = self.estimate_tokens(messages, hyperparams)
+        scheduler.num_requests += 1
+        for attempt in itertools.count():
+            await scheduler.acquire(tokens)
+            started = False
+            used_tokens = None
+            try:
+                async for elem in self.engine.stream(messages, functions, **hyperparams):
+                    started = True
+                    if isinstance(elem, BaseCompletion):
+                        used_tokens = get_used_tokens(elem)
+                    yield elem
+                return
+            except RETRYABLE_ERRORS as e:
+                # The tokens already sent cannot be taken back.
+                if started or attempt >= scheduler.max_retries:
+                    scheduler.num_failed += 1
+                    raise
+                delay = scheduler.get_delay(e, attempt)
+                scheduler.num_retries += 1
+                log.warning(f"{type(e).__name__} on attempt {attempt+1}, retrying in {delay:.1f}s.")
+            finally:
+                scheduler.release(tokens, used_tokens)
+
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        await self.engine.close()
@@ -1,37 +1,88 @@
 from kani.models import ChatMessage
-from kani.engines.openai import OpenAIEngine
-from fastapi import FastAPI, Query
+from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, APIRouter, Depends, Query, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
 from agent import Supporter, Summarizer, PersonalizedTutor
-from constant import SUPPORTER_INSTRUCTION, SUMMARIZER_INSTRUCTION, PERSONALIZED_INSTRUCTION
+from retrieval import WikiRetriever, LocalArticleStore
+from cache import ResponseCache
+from prefilter import SupportPrefilter
+from session_store import load_session_store
+from engines import load_engine_router
+from metrics import JSONLExporter, recorder, collect_gauges
+from scheduler import priority_scope, BATCH
+from prompts import get_system_prompt
+from contextlib import asynccontextmanager
+from typing import Literal
 
 import uvicorn
+import asyncio
+import weakref
+import os
 
 SPLIT = '||'
-
-app = FastAPI()
-api_key = input("OpenAI API key: ")
-engine = OpenAIEngine(api_key, model="gpt-4")
+CACHE_PATH = os.environ.get('CACHE_PATH', 'cache/server.db')  # The SQLite file to cache the responses for the retried requests. Empty to disable.
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 600))  # The seconds a cached response is reused, so that the same input is sampled again afterwards.
+MODEL_IDX = os.environ.get('MODEL_IDX', 'gpt-4')  # 'mock' runs the offline engine.
+METRICS_PATH = os.environ.get('METRICS_PATH')  # The JSONL file to append the span of each model call to.
+ENGINE_CONFIG = os.environ.get('ENGINE_CONFIG')  # The JSON file assigning an engine to each role. If not set, all agents use MODEL_IDX.
+WIKI_STORE = os.environ.get('WIKI_STORE')  # The SQLite file of the local article store. If not set, Wikipedia is searched online.
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')  # 'memory', or a SQLite file shared by the workers on the same host, where the last write of a session wins.
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 10000))  # The least recently used sessions are evicted over this.
+SESSION_IDLE_TIMEOUT = float(os.environ.get('SESSION_IDLE_TIMEOUT', 3600))  # The seconds until an idle session is evicted.
+PREFILTER = os.environ.get('PREFILTER')  # The pre-filter trained by prefilter.py. If not set, every support check asks the model.
+PREFILTER_THRESHOLD = float(os.environ.get('PREFILTER_THRESHOLD', 0.9))  # The minimum confidence of the pre-filter to skip the model.
+WORKERS = int(os.environ.get('WORKERS', 1))  # The number of worker processes when run as a script.
 
 allowed_list = ["http://localhost:3000"]
-app.add_middleware(
-  CORSMiddleware,
-  allow_origins = allowed_list,
-  allow_methods = ["*"],
-  allow_headers = ["*"]
-)
 
-# Supporter Kani.
-system_prompt = ' '.join(SUPPORTER_INSTRUCTION)
-supporter = Supporter(engine=engine, system_prompt=system_prompt)
+# System prompts of the agents. The agents are built for each request on top of the session state.
+SUPPORTER_PROMPT = get_system_prompt('supporter')
+SUMMARIZER_PROMPT = get_system_prompt('summarizer')
+PERSONALIZED_PROMPT = get_system_prompt('tutor')
+
+
+# The components shared by the requests in one worker. They are built when the worker starts up, not when the module is imported.
+class Server:
+    def __init__(self):
+        self.engines = load_engine_router(MODEL_IDX, ENGINE_CONFIG, interactive=False)
+        self.cache = ResponseCache(CACHE_PATH, ttl=CACHE_TTL) if CACHE_PATH else None
+        self.store = load_session_store(SESSION_BACKEND, max_sessions=MAX_SESSIONS, idle_timeout=SESSION_IDLE_TIMEOUT)
+        self.session_locks = weakref.WeakValueDictionary()  # session -> lock, kept only while a request of the session holds it
+        self.prefilter = SupportPrefilter.load(PREFILTER, threshold=PREFILTER_THRESHOLD) if PREFILTER else None
+        self.exporter = JSONLExporter(METRICS_PATH) if METRICS_PATH else None
+        if self.exporter is not None:
+            recorder.add_hook(self.exporter)
+
+        # The retriever is shared by the personalized tutors to reuse its cache and HTTP pool.
+        self.retriever = WikiRetriever(local_store=LocalArticleStore(WIKI_STORE) if WIKI_STORE else None)
+
+    async def close(self):
+        """Cleanly closes the kani engines and the other connections."""
+        await self.engines.close()
+        if self.exporter is not None:
+            recorder.remove_hook(self.exporter)
+            self.exporter.close()
+        await self.retriever.close()
+        if self.cache is not None:
+            self.cache.close()
+        self.store.close()
+
 
-# Summarizer Kani.
-system_prompt = ' '.join(SUMMARIZER_INSTRUCTION)
-summarizer = Summarizer(engine=engine, system_prompt=system_prompt)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.server = Server()
+    try:
+        yield
+    finally:
+        await app.state.server.close()
 
-# Personalized tutor Kani.
-system_prompt = ' '.join(PERSONALIZED_INSTRUCTION)
-tutor = PersonalizedTutor(engine=engine, system_prompt=system_prompt)
+
+def get_server(request: Request) -> Server:
+    return request.app.state.server
+
+
+router = APIRouter()
 
 
 def process_queries(queries: list[str]):
@@ -48,59 +99,168 @@ def process_queries(queries: list[str]):
     return messages
 
 
-@app.get("/checksupport/")
-async def check_support(queries: list[str] = Query(None)):
-    messages = process_queries(queries)
-    res = await supporter.check_support(messages)
+# Loading the state of the session, or starting a new session if no token is given.
+# The requests of the same session run one at a time in a worker, so that none of them overwrites the state saved by another.
+# With the SQLite backend, the requests of the same session in different workers are not serialized and the last one to save wins.
+@asynccontextmanager
+async def open_session(server: Server, session: str=None):
+    if session is None:
+        session = server.store.create()
 
-    return {'support': True} if res == 'Yes' else {'support': False}
+    lock = server.session_locks.setdefault(session, asyncio.Lock())
+    async with lock:
+        state = server.store.get(session)
+        if state is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired session.")
 
+        yield session, state
 
-@app.get("/extensions/")
-async def generate_extensions():
-    # Note that this is only exectued after running GET /checksupport.
-    extensions = await supporter.generate_support([])
 
-    return {'extensions': extensions}
+@router.get("/checksupport/")
+async def check_support(queries: list[str] = Query(None), session: str=None, server: Server=Depends(get_server)):
+    async with open_session(server, session) as (session, state):
+        supporter = Supporter(engine=server.engines.get('supporter'), system_prompt=SUPPORTER_PROMPT, name='Supporter', cache=server.cache, prefilter=server.prefilter, chat_history=list(state.get('supporter', [])))
 
+        messages = process_queries(queries)
+        res, prob = await supporter.classify_support(messages)
 
-@app.get("/rate/")
-async def rate_class(queries: list[str] = Query(None)):
-    messages = process_queries(queries)
-    score = await summarizer.rate_class(messages)
+        state['supporter'] = supporter.chat_history
+        server.store.put(session, state)
+
+    return {'support': res == 'Yes', 'probability': prob, 'session': session}
+
+
+@router.get("/extensions/")
+async def generate_extensions(session: str, server: Server=Depends(get_server)):
+    # Note that this is only exectued after running GET /checksupport with the same session.
+    async with open_session(server, session) as (session, state):
+        supporter = Supporter(engine=server.engines.get('supporter'), system_prompt=SUPPORTER_PROMPT, name='Supporter', cache=server.cache, chat_history=list(state.get('supporter', [])))
+
+        extensions = await supporter.generate_support([])
+
+        state['supporter'] = supporter.chat_history
+        server.store.put(session, state)
+
+    return {'extensions': extensions, 'session': session}
+
+
+@router.get("/rate/")
+async def rate_class(queries: list[str] = Query(None), session: str=None, server: Server=Depends(get_server)):
+    async with open_session(server, session) as (session, state):
+        summarizer = Summarizer(engine=server.engines.get('summarizer'), system_prompt=SUMMARIZER_PROMPT, name='Summarizer', cache=server.cache, chat_history=list(state.get('summarizer', [])))
+
+        messages = process_queries(queries)
+        score = await summarizer.rate_class(messages)
+
+        state['summarizer'] = summarizer.chat_history
+        server.store.put(session, state)
+
+    return {'rate': score, 'session': session}
+
+
+@router.get("/mainpoints/")
+async def generate_points(session: str, server: Server=Depends(get_server)):
+    # Note that this is only exectued after running GET /rate with the same session.
+    async with open_session(server, session) as (session, state):
+        summarizer = Summarizer(engine=server.engines.get('summarizer'), system_prompt=SUMMARIZER_PROMPT, name='Summarizer', cache=server.cache, chat_history=list(state.get('summarizer', [])))
 
-    return {'rate': score}
+        main_points = await summarizer.generate_points([])
 
+        state['summarizer'] = summarizer.chat_history
+        server.store.put(session, state)
 
-@app.get("/mainpoints/")
-async def generate_points():
-    # Note that this is only exectued after running GET /rate.
-    main_points = await summarizer.generate_points([])
+    return {'main_points': main_points, 'session': session}
 
-    return {'main_points': main_points}
 
+@router.get("/improvements/")
+async def generate_improvements(session: str, mainpoints: str=None, server: Server=Depends(get_server)):
+    # Note that this is only exectued after running GET /mainpoints with the same session.
+    async with open_session(server, session) as (session, state):
+        summarizer = Summarizer(engine=server.engines.get('summarizer'), system_prompt=SUMMARIZER_PROMPT, name='Summarizer', cache=server.cache, chat_history=list(state.get('summarizer', [])))
 
-@app.get("/improvements/")
-async def generate_improvements(mainpoints: str=None):
-    # Note that this is only exectued after running GET /improvements.
-    improvements = await summarizer.generate_improvements([], mainpoints)
+        improvements = await summarizer.generate_improvements([], mainpoints)
 
-    return {'improvements': improvements}
+        state['summarizer'] = summarizer.chat_history
+        server.store.put(session, state)
 
+    return {'improvements': improvements, 'session': session}
+
+
+@router.get("/summarize/")
+async def summarize_class(queries: list[str] = Query(None), mode: Literal['serial', 'concurrent', 'combined']='combined', server: Server=Depends(get_server)):
+    # The rating, the main points and the improvements at once, without any session.
+    summarizer = Summarizer(engine=server.engines.get('summarizer'), system_prompt=SUMMARIZER_PROMPT, name='Summarizer', cache=server.cache)
+
+    messages = process_queries(queries)
+    summary = await summarizer.summarize(messages, mode=mode)
+
+    return summary
+
+
+@router.get("/privatetutor/")
+async def generate_advice(queries: list[str] = Query(None), name: str=None, background: str=None, server: Server=Depends(get_server)):
+    # The tutor does not keep any state between the requests.
+    tutor = PersonalizedTutor(engine=server.engines.get('tutor'), system_prompt=PERSONALIZED_PROMPT, name='Tutor', cache=server.cache, retriever=server.retriever)
 
-@app.get("/privatetutor/")
-async def generate_advice(queries: list[str] = Query(None), name: str=None, background: str=None):
     messages = process_queries(queries)
     res = await tutor.generate_help(name, background, messages)
-    tutor.chat_history.clear()
 
     return {'personalized_help': res}
 
 
-@app.on_event("shutdown")
-async def cleanup_kani():
-    """When the application shuts down, cleanly close the kani engine."""
-    await engine.close()
+class Student(BaseModel):
+    name: str
+    background: str
+
+
+class ClassRoster(BaseModel):
+    queries: list[str]
+    roster: list[Student]
+
+
+@router.post("/privatetutor/batch/")
+async def generate_advice_batch(request: ClassRoster, server: Server=Depends(get_server)):
+    # The lecture transcript is sent once for the whole class, and each distinct topic is searched and explained once.
+    tutor = PersonalizedTutor(engine=server.engines.get('tutor'), system_prompt=PERSONALIZED_PROMPT, name='Tutor', cache=server.cache, retriever=server.retriever)
+
+    messages = process_queries(request.queries)
+    # The single requests waiting on the same engines go first.
+    with priority_scope(BATCH):
+        res = await tutor.generate_help_batch([(student.name, student.background) for student in request.roster], messages)
+
+    return {'personalized_help': res}
+
+
+@router.delete("/session/")
+async def end_session(session: str, server: Server=Depends(get_server)):
+    server.store.delete(session)
+
+    return {'session': session}
+
+
+@router.get("/metrics")
+async def get_metrics(server: Server=Depends(get_server)):
+    # The calls of all agents by role and method, in the Prometheus text format.
+    gauges = collect_gauges(engines=server.engines, prefilter=server.prefilter, cache=server.cache) + [('classroom_sessions', {}, len(server.store))]
+    return PlainTextResponse(recorder.prometheus(gauges))
+
+
+def create_app():
+    """The app factory, e.g. ``uvicorn server_kani:create_app --factory --workers 4``."""
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+      CORSMiddleware,
+      allow_origins = allowed_list,
+      allow_methods = ["*"],
+      allow_headers = ["*"]
+    )
+    app.include_router(router)
+
+    return app
+
+
+app = create_app()
 
 
-uvicorn.run(app)
\ No newline at end of file
+if __name__=='__main__':
+    uvicorn.run('server_kani:create_app', factory=True, workers=WORKERS)
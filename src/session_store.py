@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from kani.models import ChatMessage
+
+import sqlite3
+import json
+import time
+import uuid
+import os
+
+
+# The state of a session is a JSON-like dict, whose values can also be lists of ChatMessage (e.g. the chat histories).
+def encode_state(state: dict) -> str:
+    def _default(obj):
+        if isinstance(obj, ChatMessage):
+            return {'__chat_message__': obj.model_dump(mode='json')}
+        raise TypeError(f"Cannot serialize {type(obj).__name__} in a session.")
+
+    return json.dumps(state, default=_default)
+
+
+def decode_state(data: str) -> dict:
+    def _object_hook(obj):
+        if '__chat_message__' in obj:
+            return ChatMessage.model_validate(obj['__chat_message__'])
+        return obj
+
+    return json.loads(data, object_hook=_object_hook)
+
+
+# Bounded in-memory sessions of one worker. The least recently used sessions are evicted first.
+class MemorySessionStore:
+    def __init__(self, max_sessions: int=10000, idle_timeout: float=3600):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # token -> (last access time, state)
+
+    def create(self) -> str:
+        token = uuid.uuid4().hex
+        self.put(token, {})
+        return token
+
+    def get(self, token: str):
+        self.evict_idle()
+        if token not in self.sessions:
+            return None
+
+        _, state = self.sessions[token]
+        self.sessions[token] = (time.time(), state)
+        self.sessions.move_to_end(token)
+        return state
+
+    def put(self, token: str, state: dict):
+        self.sessions[token] = (time.time(), state)
+        self.sessions.move_to_end(token)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def delete(self, token: str):
+        self.sessions.pop(token, None)
+
+    def evict_idle(self):
+        now = time.time()
+        while len(self.sessions) > 0:
+            token, (last_access, _) = next(iter(self.sessions.items()))
+            if now - last_access <= self.idle_timeout:
+                break
+            self.sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def close(self):
+        self.sessions.clear()
+
+
+# Sessions in a local SQLite file, so that all workers on the same host can serve any session.
+class SQLiteSessionStore:
+    def __init__(self, path: str, max_sessions: int=10000, idle_timeout: float=3600):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, state TEXT NOT NULL, accessed_at REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed_at ON sessions (accessed_at)")
+        self.conn.commit()
+
+    def create(self) -> str:
+        token = uuid.uuid4().hex
+        self.put(token, {})
+        return token
+
+    def get(self, token: str):
+        self.evict_idle()
+        row = self.conn.execute("SELECT state FROM sessions WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+
+        self.conn.execute("UPDATE sessions SET accessed_at = ? WHERE token = ?", (time.time(), token))
+        self.conn.commit()
+        return decode_state(row[0])
+
+    def put(self, token: str, state: dict):
+        self.conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (token, encode_state(state), time.time()))
+        self.conn.execute(
+            "DELETE FROM sessions WHERE token IN (SELECT token FROM sessions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,)
+        )
+        self.conn.commit()
+
+    def delete(self, token: str):
+        self.conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        self.conn.commit()
+
+    def evict_idle(self):
+        self.conn.execute("DELETE FROM sessions WHERE accessed_at < ?", (time.time() - self.idle_timeout,))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def load_session_store(backend: str='memory', **kwargs):
+    """
+    :param backend: 'memory' for the in-process store, or the path of a SQLite file shared by the workers.
+    """
+    if backend == 'memory':
+        return MemorySessionStore(**kwargs)
+    return SQLiteSessionStore(backend, **kwargs)
@@ -1,34 +1,89 @@
 from concurrent.futures import process
 from kani import Kani
-from kani.engines.openai import OpenAIEngine
 from kani.models import ChatMessage
-from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, APIRouter, Depends, Request
 from starlette.websockets import WebSocket, WebSocketDisconnect
-from constant import TEACHER_INSTRUCTION, SUPPORTER_INSTRUCTION, SUMMARIZER_INSTRUCTION
-from agent import Participant, Supporter, Summarizer
-from copy import deepcopy
+from prompts import get_system_prompt
+from agent import Participant, Supporter, Summarizer, SUMMARY_MODES
+from context import ContextPolicy
+from prefilter import SupportPrefilter
+from engines import load_engine_router
+from metrics import JSONLExporter, recorder, collect_gauges
+from contextlib import asynccontextmanager
 
 import uvicorn
+import asyncio
+import os
 
 SPLIT = '||'
 MAX_TURN = 5
-
-
-app = FastAPI()
-api_key = input("OpenAI API key: ")
-engine = OpenAIEngine(api_key, model="gpt-4")
-
-# Teacher kani.
-system_prompt = ' '.join(TEACHER_INSTRUCTION)
-teacher = Participant(engine=engine, system_prompt=system_prompt)
-
-# Supporter Kani.
-system_prompt = ' '.join(SUPPORTER_INSTRUCTION)
-supporter = Supporter(engine=engine, system_prompt=system_prompt)
-
-# Summarizer Kani.
-system_prompt = ' '.join(SUMMARIZER_INSTRUCTION)
-summarizer = Summarizer(engine=engine, system_prompt=system_prompt)
+SPECULATIVE_SUPPORT = os.environ.get('SPECULATIVE_SUPPORT', '0') == '1'  # '1' generates the extensions while checking the support, trading tokens for latency.
+SUMMARY_MODE = os.environ.get('SUMMARY_MODE', 'serial')  # 'serial', 'concurrent' or 'combined'.
+if SUMMARY_MODE not in SUMMARY_MODES:
+    raise ValueError(f"SUMMARY_MODE should be one of {SUMMARY_MODES}, not {SUMMARY_MODE!r}.")
+CONTEXT_TOKENS = int(os.environ['CONTEXT_TOKENS']) if 'CONTEXT_TOKENS' in os.environ else None  # The token budget of the teacher's history in each prompt.
+SUMMARY_EVERY = int(os.environ['SUMMARY_EVERY']) if 'SUMMARY_EVERY' in os.environ else None  # The turns between the refreshes of the rolling summary.
+MODEL_IDX = os.environ.get('MODEL_IDX', 'gpt-4')  # 'mock' runs the offline engine.
+METRICS_PATH = os.environ.get('METRICS_PATH')  # The JSONL file to append the span of each model call to.
+ENGINE_CONFIG = os.environ.get('ENGINE_CONFIG')  # The JSON file assigning an engine to each role. If not set, all agents use MODEL_IDX.
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 100))  # The maximum number of classrooms running at once.
+SESSION_TIMEOUT = float(os.environ.get('SESSION_TIMEOUT', 30))  # The seconds a new connection waits for a free classroom.
+PREFILTER = os.environ.get('PREFILTER')  # The pre-filter trained by prefilter.py. If not set, every support check asks the model.
+PREFILTER_THRESHOLD = float(os.environ.get('PREFILTER_THRESHOLD', 0.9))  # The minimum confidence of the pre-filter to skip the model.
+WORKERS = int(os.environ.get('WORKERS', 1))  # The number of worker processes when run as a script.
+
+
+# The components shared by the classrooms in one worker. They are built when the worker starts up, not when the module is imported.
+class Server:
+    def __init__(self):
+        self.engines = load_engine_router(MODEL_IDX, ENGINE_CONFIG, interactive=False)
+        self.sessions = asyncio.Semaphore(MAX_SESSIONS)
+        self.classrooms = set()  # The websockets of the running classrooms.
+        self.prefilter = SupportPrefilter.load(PREFILTER, threshold=PREFILTER_THRESHOLD) if PREFILTER else None
+        self.exporter = JSONLExporter(METRICS_PATH) if METRICS_PATH else None
+        if self.exporter is not None:
+            recorder.add_hook(self.exporter)
+
+    # Building the agents of one classroom. They only hold the chat histories and share the engines with their HTTP pools.
+    def build_classroom(self):
+        # Teacher kani.
+        system_prompt = get_system_prompt('teacher')
+        context_policy = ContextPolicy(max_tokens=CONTEXT_TOKENS, summary_every=SUMMARY_EVERY)
+        teacher = Participant(engine=self.engines.get('teacher'), system_prompt=system_prompt, name='Teacher', context_policy=context_policy)
+
+        # Supporter Kani.
+        system_prompt = get_system_prompt('supporter')
+        supporter = Supporter(engine=self.engines.get('supporter'), system_prompt=system_prompt, name='Supporter', prefilter=self.prefilter)
+
+        # Summarizer Kani.
+        system_prompt = get_system_prompt('summarizer')
+        summarizer = Summarizer(engine=self.engines.get('summarizer'), system_prompt=system_prompt, name='Summarizer')
+
+        return teacher, supporter, summarizer
+
+    async def close(self):
+        """Cleanly closes the kani engines."""
+        await self.engines.close()
+        if self.exporter is not None:
+            recorder.remove_hook(self.exporter)
+            self.exporter.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.server = Server()
+    try:
+        yield
+    finally:
+        await app.state.server.close()
+
+
+def get_server(request: Request) -> Server:
+    return request.app.state.server
+
+
+router = APIRouter()
 
 
 def process_messasges(messages: list[ChatMessage]):
@@ -42,56 +97,101 @@ def process_messasges(messages: list[ChatMessage]):
     return res
 
 
-@app.websocket("/simulate/{topic}")
-async def kani_chat(websocket: WebSocket, topic: str=None):
+# Sending each message either as one text frame, or as JSON frames of the tokens followed by an end-of-message frame.
+# The type of each message is one of 'teacher', 'supporter', 'review', 'main_points' and 'improvements'.
+class MessageSender:
+    def __init__(self, websocket: WebSocket, stream: bool=False):
+        self.websocket = websocket
+        self.stream = stream
+
+    def on_token(self, type: str):
+        if not self.stream:
+            return None
+
+        async def _send_token(token: str):
+            await self.websocket.send_json({'type': type, 'delta': token})
+
+        return _send_token
+
+    async def send(self, type: str, content: str):
+        if self.stream:
+            await self.websocket.send_json({'type': type, 'end': True, 'content': content})
+        else:
+            await self.websocket.send_text(content)
+
+
+@router.websocket("/simulate/{topic}")
+async def kani_chat(websocket: WebSocket, topic: str=None, stream: bool=False):
     # accept the websocket and initialize a kani for the connection
     await websocket.accept()
+    server = websocket.app.state.server
+
+    # Waiting for a free classroom, and rejecting the connection if the server stays full.
+    try:
+        await asyncio.wait_for(server.sessions.acquire(), timeout=SESSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        await websocket.close(code=1013, reason="Too many classrooms. Try again later.")
+        return
+
+    server.classrooms.add(websocket)
+    try:
+        teacher, supporter, summarizer = server.build_classroom()
+        await run_classroom(MessageSender(websocket, stream=stream), topic, teacher, supporter, summarizer)
+    finally:
+        server.classrooms.discard(websocket)
+        server.sessions.release()
 
+
+async def run_classroom(sender: MessageSender, topic: str, teacher: Participant, supporter: Supporter, summarizer: Summarizer):
     # Starting the course.
-    res = await teacher.chat_round_str([ChatMessage.user(f"Generate the introduction of today's lecture topic: {topic}.")])
+    res = await teacher.chat_round_str([ChatMessage.user(f"Generate the introduction of today's lecture topic: {topic}.")], on_token=sender.on_token('teacher'))
     teacher.chat_history = teacher.chat_history[1:]
     turn = []
     num_turns = 0
 
-    await websocket.send_text(res)
+    await sender.send('teacher', res)
     turn.append(ChatMessage.user(name='Teacher', content=res))
 
     # take string messages and send string responses
     while True:
         try:
-            check = await supporter.check_support(deepcopy(turn))
+            if SPECULATIVE_SUPPORT:
+                check, extensions = await supporter.speculate_support(turn)
+            else:
+                check = await supporter.check_support(turn)
+                extensions = await supporter.generate_support([], on_token=sender.on_token('supporter')) if check == 'Yes' else None
+
             if check == 'Yes':
-                extensions = await supporter.generate_support([])
-                await websocket.send_text(extensions)
+                await sender.send('supporter', extensions)
 
-                better_res = await teacher.chat_round_str([ChatMessage.system(name='Supporter', content=extensions)])
-                await websocket.send_text(better_res)
+                better_res = await teacher.chat_round_str([ChatMessage.system(name='Supporter', content=extensions)], on_token=sender.on_token('teacher'))
+                await sender.send('teacher', better_res)
 
             turn.clear()
 
-            texts = await websocket.receive_text()
+            texts = await sender.websocket.receive_text()
             for text in texts.split('||'):
                 turn.append(ChatMessage.user(name='Student', content=text))
 
-            res = await teacher.chat_round_str(turn)
-            await websocket.send_text(res)
+            res = await teacher.chat_round_str(turn, on_token=sender.on_token('teacher'))
+            await sender.send('teacher', res)
             turn.append(ChatMessage.user(name='Teacher', content=res))
 
             num_turns += 1
             if num_turns == MAX_TURN:
-                class_logs = process_messasges(teacher.chat_history)
-
-                # Review.
-                review = await summarizer.rate_class(class_logs)
-                await websocket.send_text(review)
+                class_logs = process_messasges(teacher.get_class_messages())
 
-                # Main points.
-                main_points = await summarizer.generate_points([])
-                await websocket.send_text(main_points)
+                # The review, the main points and the improvements.
+                on_token = {
+                    'rate': sender.on_token('review'),
+                    'main_points': sender.on_token('main_points'),
+                    'improvements': sender.on_token('improvements')
+                }
+                summary = await summarizer.summarize(class_logs, mode=SUMMARY_MODE, on_token=on_token)
 
-                # Improvements.
-                improvements = await summarizer.generate_improvements([], main_points)
-                await websocket.send_text(improvements)
+                await sender.send('review', summary['rate'])
+                await sender.send('main_points', summary['main_points'])
+                await sender.send('improvements', summary['improvements'])
 
                 break
 
@@ -100,10 +200,23 @@ async def kani_chat(websocket: WebSocket, topic: str=None):
             return
 
 
-@app.on_event("shutdown")
-async def cleanup_kani():
-    """When the application shuts down, cleanly close the kani engine."""
-    await engine.close()
+@router.get("/metrics")
+async def get_metrics(server: Server=Depends(get_server)):
+    # The calls of all agents by role and method, in the Prometheus text format.
+    gauges = collect_gauges(engines=server.engines, prefilter=server.prefilter, cache=None) + [('classroom_active_classrooms', {}, len(server.classrooms))]
+    return PlainTextResponse(recorder.prometheus(gauges))
+
+
+def create_app():
+    """The app factory, e.g. ``uvicorn socket_kani:create_app --factory --workers 4``."""
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+
+    return app
+
+
+app = create_app()
 
 
-uvicorn.run(app)
+if __name__=='__main__':
+    uvicorn.run('socket_kani:create_app', factory=True, workers=WORKERS)
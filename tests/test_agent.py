@@ -0,0 +1,91 @@
+from kani.models import ChatMessage
+from agent import Participant, Supporter, Summarizer
+from context import ContextPolicy
+from mock_engine import MockEngine
+from prefilter import SupportPrefilter
+from prompts import PrefixTracker
+from cache import ResponseCache
+from metrics import MetricsRecorder
+from prompts import get_system_prompt
+
+import agent
+import asyncio
+import pytest
+
+# The support is always needed, and the extensions are the same whatever the prompt.
+RESPONSES = {"needs some support": "0", "suggest about 2-3": "More about photosynthesis."}
+
+
+def make_supporter(prefilter: SupportPrefilter=None):
+    engine = MockEngine(latency=0, latency_std=0, responses=RESPONSES)
+    return Supporter(engine=engine, system_prompt=get_system_prompt('supporter'), name='Supporter', prefilter=prefilter)
+
+
+def dump(history: list[ChatMessage]):
+    return [(msg.role.value, msg.name, msg.content) for msg in history]
+
+
+@pytest.mark.parametrize('prefilter', [None, SupportPrefilter().fit([("Plants use sunlight to make their food.", 'Yes'), ("Any questions?", 'No')])])
+def test_speculative_support_keeps_serial_history(prefilter):
+    queries = [
+        ChatMessage.user(name='Student-1', content="Why do plants need sunlight?"),
+        ChatMessage.user(name='Teacher', content="Plants use sunlight to make their food."),
+    ]
+
+    async def run():
+        serial = make_supporter(prefilter)
+        res = await serial.check_support(queries)
+        extensions = await serial.generate_support(queries)
+
+        speculative = make_supporter(prefilter)
+        spec_res, spec_extensions = await speculative.speculate_support(queries)
+
+        return (res, extensions, serial.chat_history), (spec_res, spec_extensions, speculative.chat_history)
+
+    (res, extensions, history), (spec_res, spec_extensions, spec_history) = asyncio.run(run())
+    assert (res, extensions) == (spec_res, spec_extensions) == ('Yes', "More about photosynthesis.")
+    assert dump(spec_history) == dump(history)
+
+
+def test_context_window_keeps_current_round():
+    engine = MockEngine(latency=0, latency_std=0)
+    teacher = Participant(engine=engine, system_prompt=get_system_prompt('teacher', 'plants'), name='Teacher', context_policy=ContextPolicy(max_tokens=8))
+    query = ChatMessage.user(name='Student-1', content="Could you explain again how the leaves turn the sunlight, the water and the air into sugar?")
+    assert teacher.message_token_len(query) > 8
+
+    asyncio.run(teacher.chat_round([query]))
+    assert teacher.num_prompt_messages == 2  # The system prompt and the question.
+
+
+@pytest.mark.parametrize('response, main_points', [
+    ('{"rate": "8/10", "main_points": ["Sunlight", "Chlorophyll"], "improvements": "More examples."}', "Sunlight\nChlorophyll"),
+    ('{"rate": 8, "main_points": "Sunlight", "improvements": "More examples."}', None),
+])
+def test_combined_summary_parts_are_texts(response, main_points):
+    engine = MockEngine(latency=0, latency_std=0, responses={"Wrap up the lecture": response})
+    summarizer = Summarizer(engine=engine, system_prompt=get_system_prompt('summarizer'), name='Summarizer')
+    queries = [ChatMessage.user(name='Teacher', content="Plants use sunlight to make their food.")]
+
+    summary = asyncio.run(summarizer.generate_summary(queries))
+    assert (summary['main_points'] if summary is not None else None) == main_points
+
+
+def test_cached_prompts_are_not_counted_as_sent(tmp_path, monkeypatch):
+    engine = MockEngine(latency=0, latency_std=0)
+    cache = ResponseCache(str(tmp_path / 'responses.db'))
+    spans = []
+    metrics = MetricsRecorder()
+    metrics.add_hook(spans.append)
+    query = ChatMessage.user(name='Student-1', content="Why do plants need sunlight?")
+
+    def ask(cache: ResponseCache=None):
+        teacher = Participant(engine=engine, system_prompt=get_system_prompt('teacher', 'plants'), name='Teacher', cache=cache, metrics=metrics)
+        asyncio.run(teacher.chat_round([query]))
+
+    ask(cache)  # Sent to the model and cached.
+    monkeypatch.setattr(agent, 'prefixes', PrefixTracker())
+    ask(cache)  # Answered from the cache, never sent.
+    ask()  # Sent again, with nothing of it sent before as far as the new tracker knows.
+    cache.close()
+
+    assert [(span['cached'], span['prefix_tokens']) for span in spans[1:]] == [(True, 0), (False, 0)]
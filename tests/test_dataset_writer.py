@@ -0,0 +1,24 @@
+from kani.models import ChatMessage
+from dataset_writer import DatasetWriter, iter_lectures, load_runs
+
+import argparse
+import pytest
+
+
+def make_args(topic: str):
+    return argparse.Namespace(topic=topic, seed=555, model_idx='mock', num_students=4, max_turns=10)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_writers_share_directory(tmp_path, compress):
+    # e.g. one generate_data.py process per topic on the same --dataset_dir.
+    writers = [DatasetWriter(str(tmp_path), compress=compress) for _ in range(2)]
+    runs = [writer.start_run(make_args(topic)) for writer, topic in zip(writers, ['Plants', 'Planets'])]
+    for run, topic in zip(runs, ['Plants', 'Planets']):
+        run.finish(0, [ChatMessage.assistant(f"Today we learn about {topic}.")])
+    for writer in writers:
+        writer.close()
+
+    lectures = {lecture['params']['topic']: lecture['messages'] for lecture in iter_lectures(str(tmp_path))}
+    assert lectures == {topic: [{'role': 'assistant', 'name': None, 'content': f"Today we learn about {topic}."}] for topic in ['Plants', 'Planets']}
+    assert all(entry['status'] == 'finished' for entry in load_runs(str(tmp_path)).values())